@@ -5,4 +5,9 @@ from config import *
 from git import *
 from srcname import *
 
+import buildorder
+import planner
+import sourcecache
 import reprepro
+import tracing
+import versions
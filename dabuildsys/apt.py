@@ -16,38 +16,62 @@ Classes related to reading the APT repository.
 # Why is the structure of this repository so complicated?
 #
 
+import cache
 import config
-from checkout import PackageCheckout
-from common import BuildError
+import tracing
+from checkout import load_checkouts
+from common import BuildError, parallel_map
+from versions import get_version
 
-from debian.debian_support import Version
-from collections import defaultdict
+from collections import defaultdict, Mapping, OrderedDict
 from contextlib import closing
 import debian.deb822
 import glob
 import gzip
+import io
 import lzma
 import os.path
 import re
 import tarfile
 
+# The package records below are kept for every package in every loaded
+# pocket, so they use __slots__ and keep only the fields which are actually
+# read; the names repeated across them are interned.
+
 class APTFile(object):
     """A file in the APT repository."""
 
+    __slots__ = ('name', 'basedir', 'sha256')
+
     def __init__(self, name, basedir, sha256):
         self.name = name
-        self.path = os.path.join(basedir, name)
+        self.basedir = basedir
         self.sha256 = sha256
 
+    @property
+    def path(self):
+        return os.path.join(self.basedir, self.name)
+
 class APTSourcePackage(object):
-    def __init__(self, name, manifest):
-        self.name = name
-        self.version = Version(manifest['Version'])
-        self.architecture = manifest['Architecture']
-        self.binaries = manifest['Binary'].split(', ')
-        self.manifest = manifest
-        self.relations = manifest.relations
-        self.format = manifest['Format']
+    __slots__ = ('name', 'version', 'architecture', 'binaries', 'format', 'has_package_list',
+                 'raw_relations', 'parsed_relations', 'cached_architectures', 'origin', 'files')
+
+    def __init__(self, name, version, architecture, binaries, format, has_package_list, raw_relations):
+        self.name = intern(name)
+        self.version = get_version(version)
+        self.architecture = intern(architecture)
+        self.binaries = tuple(intern(binary) for binary in binaries)
+        self.format = intern(format)
+        self.has_package_list = has_package_list
+        self.raw_relations = raw_relations
+
+    @property
+    def relations(self):
+        try:
+            return self.parsed_relations
+        except AttributeError:
+            self.parsed_relations = parse_relations(source_relation_fields, self.raw_relations)
+            return self.parsed_relations
 
     def __str__(self):
         return "%s=%s" % (self.name, self.version)
@@ -55,50 +79,65 @@ class APTSourcePackage(object):
     def __repr__(self):
         return str(self)
 
-    def get_control_file(self):
-        """Extract control file from the source package."""
+    def get_control_source(self):
+        """Returns the file (as APTFile) of the source package which contains
+        the control file."""
 
-        controlname = "%s-%s/debian/control" % (self.name, str(self.version))
         if self.format.startswith('3.0'):
             if self.format == '3.0 (native)':
                 tarname = "%s_%s.tar." % (self.name, str(self.version))
             elif self.format == '3.0 (quilt)':
                 tarname = "%s_%s.debian.tar." % (self.name, str(self.version))
-                controlname = "debian/control"
             else:
                 raise BuildError("Package %s has unsupported format %s in archive" % (self.name, self.format))
 
             try:
-                tarpath, = [f.path for f in self.files if f.name.startswith(tarname)]
+                source_file, = [f for f in self.files if f.name.startswith(tarname)]
             except ValueError:
                 raise BuildError("File %s.{gz,bz2,xz} not found for package %s" % (tarname, self.name))
+            return source_file
 
-            with closing(lzma.LZMAFile(tarpath, 'r')) if tarpath.endswith('.xz') \
-                 else open(tarpath, 'r') as uncompressed:
-                with tarfile.open(fileobj=uncompressed, mode='r:*') as tar:
-                    return list(debian.deb822.Deb822.iter_paragraphs(
-                        tar.extractfile(controlname)  ))
-
-        # FIXME: this code should be gone once 1.0 packages are gone
-        # I still can't believe I actually wrote this
         elif self.format == '1.0':
             if len(self.files) == 2:
                 try:
-                    tarpath, = [f.path for f in self.files if f.name.endswith('.tar.gz')]
+                    source_file, = [f for f in self.files if f.name.endswith('.tar.gz')]
                 except ValueError:
                     raise BuildError("Package %s has format 1.0 and does not seem to have the tarball" % self.name)
-
-                with tarfile.open(tarpath, 'r:*') as tar:
-                    return list(debian.deb822.Deb822.iter_paragraphs(
-                        tar.extractfile(controlname)  ))
+                return source_file
             else:
                 diffname = "%s_%s.diff.gz" % (self.name, str(self.version))
                 try:
-                    diffpath, = [f.path for f in self.files if f.name == diffname]
+                    source_file, = [f for f in self.files if f.name == diffname]
                 except ValueError:
                     raise BuildError("File %s not found for package %s" % (diffname, self.name))
+                return source_file
+        else:
+            raise BuildError("Package %s has unsupported format %s in archive" % (self.name, self.format))
+
+    def get_control_file(self):
+        """Extract control file from the source package."""
+
+        path = self.get_control_source().path
+        controlname = "%s-%s/debian/control" % (self.name, str(self.version))
+        if self.format.startswith('3.0'):
+            if self.format == '3.0 (quilt)':
+                controlname = "debian/control"
+
+            with closing(lzma.LZMAFile(path, 'r')) if path.endswith('.xz') \
+                 else open(path, 'r') as uncompressed:
+                with tarfile.open(fileobj=uncompressed, mode='r:*') as tar:
+                    return list(debian.deb822.Deb822.iter_paragraphs(
+                        tar.extractfile(controlname)  ))
 
-                diff = gzip.open(diffpath, 'r')
+        # FIXME: this code should be gone once 1.0 packages are gone
+        # I still can't believe I actually wrote this
+        elif self.format == '1.0':
+            if len(self.files) == 2:
+                with tarfile.open(path, 'r:*') as tar:
+                    return list(debian.deb822.Deb822.iter_paragraphs(
+                        tar.extractfile(controlname)  ))
+            else:
+                diff = gzip.open(path, 'r')
                 while True:
                     line = diff.readline().strip()
                     if line.startswith('--- ') and line.endswith('/debian/control'):
@@ -117,12 +156,10 @@ class APTSourcePackage(object):
                             lines.append(diff.readline()[1:])
 
                         return list(debian.deb822.Deb822.iter_paragraphs(lines))
-        else:
-            raise BuildError("Package %s has unsupported format %s in archive" % (self.name, self.format))
 
-    def get_binary_architectures(self):
-        """Returns the dictionary of binary packages to list of architectures
-        for which those packages are built."""
+    def needs_control_file(self):
+        """Checks whether the control file has to be read in order to find
+        out the architectures of the binary packages."""
 
         # See commit 47126733bb in dpkg.
         # Prior to May 15, 2011, dpkg did not output "Architecture: any all"
@@ -130,22 +167,20 @@ class APTSourcePackage(object):
         # Here I attempt to detect those buggy packages by asserting that
         # packages with Package-List (which was finally introduced on May 28
         # same year, though it kind of existed some time before).
-        dpkg_bug = 'Package-List' not in self.manifest
+        dpkg_bug = not self.has_package_list
 
         arches_naive = self.architecture.split(' ')
         if len(self.binaries) == 1:
-            return { self.binaries[0] : arches_naive }
+            return False
         if not dpkg_bug and arches_naive == ['all']:
-            return { binary: arches_naive for binary in self.binaries }
+            return False
         # "any" is unsafe because some of the binaries may have more
         # restrictive architectures
+        return True
 
-        # Actually, very limited number of packages gets here
-        # Cache those which still do
-        try:
-            return self.cached_architectures
-        except AttributeError:
-            pass
+    def read_binary_architectures(self):
+        """Reads the architectures of the binary packages from the control
+        file, bypassing all caches."""
 
         control = self.get_control_file()
         binaries = {}
@@ -155,20 +190,96 @@ class APTSourcePackage(object):
 
             binaries[package['Package']] = package['Architecture'].split(' ')
 
+        return binaries
+
+    def get_binary_architectures(self):
+        """Returns the dictionary of binary packages to list of architectures
+        for which those packages are built."""
+
+        arches_naive = self.architecture.split(' ')
+        if not self.needs_control_file():
+            return { binary: arches_naive for binary in self.binaries }
+
+        # Actually, very limited number of packages gets here
+        # Cache those which still do, both in memory and on disk
+        try:
+            return self.cached_architectures
+        except AttributeError:
+            pass
+
+        source_file = self.get_control_source()
+        entry = cache.load('control-architectures', source_file.sha256)
+        if entry and os.path.exists(entry[0]):
+            binaries = entry[1]
+        else:
+            if entry:
+                # The pool file is gone
+                cache.remove('control-architectures', source_file.sha256)
+            binaries = self.read_binary_architectures()
+            cache.store('control-architectures', source_file.sha256, (source_file.path, binaries))
+
         if set(binaries) != set(self.binaries):
             raise BuildError("Package %s has mismatching list of binaries in dsc and control file" % self.name)
 
         self.cached_architectures = binaries
         return binaries
 
+def read_control_architectures(pkg):
+    """Worker for prefill_control_cache.  Errors are left to be reported
+    when the architectures are actually requested."""
+
+    try:
+        return pkg.read_binary_architectures()
+    except Exception:
+        return None
+
+@tracing.traced("read control files")
+def prefill_control_cache(sources, jobs=1):
+    """Read the binary architectures of all given source packages which are
+    not in the cache yet using the specified number of processes, and store
+    them into the cache.  Afterwards, drop the cache entries for the files
+    which are no longer in the pool."""
+
+    missing = {}
+    for pkg in sources:
+        if not pkg.needs_control_file() or hasattr(pkg, 'cached_architectures'):
+            continue
+        try:
+            source_file = pkg.get_control_source()
+        except BuildError:
+            continue
+        entry = cache.load('control-architectures', source_file.sha256)
+        if not entry or not os.path.exists(entry[0]):
+            missing[source_file.sha256] = pkg, source_file
+
+    pending = missing.values()
+    results = parallel_map(read_control_architectures, [pkg for pkg, _ in pending], jobs, processes=True)
+    for (pkg, source_file), binaries in zip(pending, results):
+        if binaries is not None:
+            cache.store('control-architectures', source_file.sha256, (source_file.path, binaries))
+
+    cache.prune('control-architectures', lambda entry: not os.path.exists(entry[0]))
+
 class APTBinaryPackage(object):
-    def __init__(self, name, version, architecture, manifest):
-        self.name = name
-        self.architecture = architecture
-        self.full_version = version
-        self.version = Version(version)
-        self.manifest = manifest
-        self.relations = manifest.relations
+    __slots__ = ('name', 'architecture', 'version', 'raw_relations', 'parsed_relations', 'file')
+
+    def __init__(self, name, version, architecture, raw_relations):
+        self.name = intern(name)
+        self.architecture = intern(architecture)
+        self.version = get_version(version)
+        self.raw_relations = raw_relations
+
+    @property
+    def full_version(self):
+        return self.version.full_version
+
+    @property
+    def relations(self):
+        try:
+            return self.parsed_relations
+        except AttributeError:
+            self.parsed_relations = parse_relations(binary_relation_fields, self.raw_relations)
+            return self.parsed_relations
 
     def __str__(self):
         return "%s:%s=%s" % (self.name, self.architecture, self.version)
@@ -176,8 +287,197 @@ class APTBinaryPackage(object):
     def __repr__(self):
         return str(self)
 
+# Relationship fields, in the same set deb822 uses for Sources and Packages
+source_relation_fields = ['build-depends', 'build-depends-indep',
+        'build-conflicts', 'build-conflicts-indep', 'binary']
+binary_relation_fields = ['depends', 'pre-depends', 'recommends', 'suggests',
+        'breaks', 'conflicts', 'provides', 'replaces', 'enhances', 'built-using']
+
+source_fields = frozenset(['package', 'version', 'architecture', 'binary', 'format',
+        'package-list', 'directory', 'checksums-sha256'] + source_relation_fields)
+binary_fields = frozenset(['package', 'version', 'architecture', 'filename', 'sha256'] +
+        binary_relation_fields)
+
+# Bump whenever the layout of records produced by parse_*_file changes
+index_cache_format = 3
+
+# Preferred variants of index files, in order
+index_suffixes = ['', '.gz', '.xz']
+
+def get_raw_relations(fields, paragraph):
+    """Returns the values of the relationship fields of the paragraph as a
+    tuple in the order of fields, or None if it has none of them."""
+
+    raw = tuple(paragraph.get(field) for field in fields)
+    return raw if any(raw) else None
+
+def parse_relations(fields, raw):
+    """Parse the raw relationship fields, as returned by get_raw_relations(),
+    into the structure which deb822 returns as the relations property."""
+
+    raw = raw or (None,) * len(fields)
+    return { field : debian.deb822.PkgRelation.parse_relations(value) if value else []
+             for field, value in zip(fields, raw) }
+
+def open_index(path):
+    """Open a possibly compressed index file for reading."""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'r')
+    elif path.endswith('.xz'):
+        # LZMAFile.readline is not reliable near the end of file, so
+        # decompress it all at once
+        with closing(lzma.LZMAFile(path, 'r')) as compressed:
+            return io.BytesIO(compressed.read())
+    else:
+        return open(path, 'r')
+
+def find_index_files(pattern):
+    """Given a glob pattern for index file without compression suffix, find
+    the most preferable existing variant of each index file."""
+
+    bases = set()
+    for suffix in index_suffixes:
+        bases |= set(path[:len(path) - len(suffix)] for path in glob.glob(pattern + suffix))
+
+    result = []
+    for base in sorted(bases):
+        for suffix in index_suffixes:
+            if os.path.isfile(base + suffix):
+                result.append(base + suffix)
+                break
+
+    return result
+
+def iter_index_paragraphs(index_file, fields):
+    """Stream the paragraphs of a Sources or Packages file, yielding for each
+    paragraph a dictionary of only specified fields (with lowercase names).
+    The values are the same as deb822 would return; this is much faster
+    because nothing is done for the fields we do not use."""
+
+    paragraph = {}
+    key = None
+    for line in iter(index_file.readline, ''):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if key and line.strip():
+                paragraph[key] += '\n' + line
+            elif not line.strip():
+                if paragraph:
+                    yield paragraph
+                paragraph = {}
+                key = None
+        elif not line:
+            if paragraph:
+                yield paragraph
+            paragraph = {}
+            key = None
+        elif line[0] != '#' and ':' in line:
+            key, value = line.split(':', 1)
+            key = key.strip().lower()
+            if key in fields:
+                paragraph[key] = value.strip()
+            else:
+                key = None
+
+    if paragraph:
+        yield paragraph
+
+def parse_sources_file(path):
+    """Reads the Sources index into the list of compact records, which are
+    what is stored in the on-disk index cache."""
+
+    with open_index(path) as sources_file:
+        return [(
+            source_pkg['package'],
+            source_pkg['version'],
+            source_pkg['architecture'],
+            source_pkg['binary'].split(', '),
+            source_pkg['format'],
+            'package-list' in source_pkg,
+            get_raw_relations(source_relation_fields, source_pkg),
+            source_pkg['directory'],
+            [(line.split()[2], line.split()[0]) for line in source_pkg['checksums-sha256'].splitlines() if line],
+        ) for source_pkg in iter_index_paragraphs(sources_file, source_fields)]
+
+def parse_packages_file(path):
+    """Reads the Packages index into the list of compact records."""
+
+    with open_index(path) as packages_file:
+        return [(
+            binary_pkg['package'],
+            binary_pkg['version'],
+            binary_pkg['architecture'],
+            get_raw_relations(binary_relation_fields, binary_pkg),
+            binary_pkg['filename'],
+            binary_pkg['sha256'],
+        ) for binary_pkg in iter_index_paragraphs(packages_file, binary_fields)]
+
+def read_sources_file(path):
+    """Returns parse_sources_file(path), cached on disk."""
+
+    return cache.load_by_stamp('sources', path, parse_sources_file, index_cache_format)
+
+def read_packages_file(path):
+    """Returns parse_packages_file(path), cached on disk."""
+
+    return cache.load_by_stamp('packages', path, parse_packages_file, index_cache_format)
+
+def newest(upper, lower):
+    """Pick the newer of two packages, preferring the upper one on ties."""
+
+    return lower if upper.version < lower.version else upper
+
+class StackedSources(Mapping):
+    """Read-only view of the source packages of one pocket stacked on top of
+    another one.  Lookups return the newest version of the package from
+    either of them; nothing is copied."""
+
+    def __init__(self, upper, lower):
+        self.upper = upper
+        self.lower = lower
+
+    def __getitem__(self, name):
+        if name not in self.upper:
+            return self.lower[name]
+        if name not in self.lower:
+            return self.upper[name]
+        return newest(self.upper[name], self.lower[name])
+
+    def __contains__(self, name):
+        return name in self.upper or name in self.lower
+
+    def __iter__(self):
+        for name in self.upper:
+            yield name
+        for name in self.lower:
+            if name not in self.upper:
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+class StackedBinaries(StackedSources):
+    """Same as StackedSources, but for { architecture : package } maps,
+    which are merged per architecture."""
+
+    def __getitem__(self, name):
+        if name not in self.upper:
+            return self.lower[name]
+        if name not in self.lower:
+            return self.upper[name]
+
+        merged = dict(self.lower[name])
+        for arch, pkg in self.upper[name].iteritems():
+            merged[arch] = newest(pkg, merged[arch]) if arch in merged else pkg
+        return merged
+
 class APTDistribution(object):
-    def __init__(self, name):
+    def __init__(self, name, base=None):
+        """Create a distribution.  If base is specified, packages from the
+        base distribution are visible in this one, unless this one has a
+        newer version.  Indexes are only loaded when first queried."""
+
         if isinstance(name, tuple):
             self.release, self.pocket = name
             name = '-'.join(name) if name[1] != '' else name[0]
@@ -186,108 +486,269 @@ class APTDistribution(object):
 
         self.name = name
         self.path = os.path.join(config.apt_root_dir, 'dists', name)
+        self.base = base
+
+    @property
+    def sources(self):
+        try:
+            return self.sources_view
+        except AttributeError:
+            pass
+
         self.load_sources()
-        self.load_binaries()
+        self.sources_view = StackedSources(self.own_sources, self.base.sources) if self.base else self.own_sources
+        return self.sources_view
 
-    def load_sources(self):
-        self.sources = {}
-        for sources_file_path in glob.glob(os.path.join(self.path, '*', 'source',  'Sources')):
-            with open(sources_file_path, 'r') as sources_file:
-                for source_pkg in debian.deb822.Sources.iter_paragraphs(sources_file):
-                    pkg = APTSourcePackage(source_pkg['Package'], source_pkg)
-                    pkg.origin = self.name
-                    basedir = os.path.join(config.apt_root_dir, source_pkg['Directory'])
-                    pkg.files = [APTFile(f['name'], basedir, f['sha256']) for f in source_pkg['Checksums-Sha256']]
-                    self.sources[pkg.name] = pkg
+    @property
+    def binaries(self):
+        try:
+            return self.binaries_view
+        except AttributeError:
+            pass
 
+        self.load_binaries()
+        self.binaries_view = StackedBinaries(self.own_binaries, self.base.binaries) if self.base else self.own_binaries
+        return self.binaries_view
+
+    def find_source_indexes(self):
+        return find_index_files(os.path.join(self.path, '*', 'source',  'Sources'))
+
+    def find_binary_indexes(self):
+        return find_index_files(os.path.join(self.path, '*', 'binary-*', 'Packages'))
+
+    def read_source_index(self, path):
+        """Returns the { name : package } map of one Sources file."""
+
+        packages = {}
+        for record in read_sources_file(path):
+            directory, files = record[-2:]
+            pkg = APTSourcePackage(*record[:-2])
+            pkg.origin = self.name
+            basedir = intern(os.path.join(config.apt_root_dir, directory))
+            pkg.files = tuple(APTFile(name, basedir, sha256) for name, sha256 in files)
+            packages[pkg.name] = pkg
+        return packages
+
+    def read_binary_index(self, path):
+        """Returns the { (name, architecture) : package } map of one
+        Packages file."""
+
+        packages = {}
+        for record in read_packages_file(path):
+            filename, sha256 = record[-2:]
+            pkg = APTBinaryPackage(*record[:-2])
+            basedir, name = os.path.split(os.path.join(config.apt_root_dir, filename))
+            pkg.file = APTFile(name, intern(basedir), sha256)
+            packages[pkg.name, pkg.architecture] = pkg
+        return packages
+
+    @tracing.traced("load Sources indexes")
+    def load_sources(self):
+        # { path : (stamp, packages) } of every index file, kept for refresh()
+        self.source_indexes = OrderedDict()
+        self.own_sources = {}
+        for path in self.find_source_indexes():
+            stamp = cache.file_stamp(path)
+            packages = self.read_source_index(path)
+            self.source_indexes[path] = (stamp, packages)
+            self.own_sources.update(packages)
+
+    @tracing.traced("load Packages indexes")
     def load_binaries(self):
-        self.binaries = defaultdict(dict)
-        for packages_file_path in glob.glob(os.path.join(self.path, '*', 'binary-*', 'Packages')):
-            with open(packages_file_path, 'r') as packages_file:
-                for binary_pkg in debian.deb822.Packages.iter_paragraphs(packages_file):
-                    pkg = APTBinaryPackage(binary_pkg['Package'], binary_pkg['Version'], binary_pkg['Architecture'], binary_pkg)
-                    path = os.path.join(config.apt_root_dir, binary_pkg['Filename'])
-                    pkg.file = APTFile(os.path.basename(path), path, binary_pkg['SHA256'])
-                    self.binaries[pkg.name][pkg.architecture] = pkg
-
-    def merge(self, other):
-        """Adds the packages from other distribution, as long as they do not
-        override the newer packages in current."""
-
-        for name, pkg_other in other.sources.iteritems():
-            pkg_cur = self.sources.get(name)
-            if not pkg_cur or pkg_cur.version < pkg_other.version:
-                self.sources[name] = pkg_other
-
-        for name, pkgs_other in other.binaries.iteritems():
-            for arch, pkg_other in pkgs_other.iteritems():
-                pkg_cur = self.binaries.get(name)
-                if pkg_cur:
-                    pkg_cur = pkg_cur.get(arch)
-                    if not pkg_cur or pkg_cur.version < pkg_other.version:
-                        self.binaries[name][arch] = pkg_other
-                else:
-                    self.binaries[name] = {}
-                    self.binaries[name][arch] = pkg_other
-
-    def out_of_date_binaries(self, arch):
+        self.binary_indexes = OrderedDict()
+        self.own_binaries = defaultdict(dict)
+        for path in self.find_binary_indexes():
+            stamp = cache.file_stamp(path)
+            packages = self.read_binary_index(path)
+            self.binary_indexes[path] = (stamp, packages)
+            for (name, arch), pkg in packages.iteritems():
+                self.own_binaries[name][arch] = pkg
+
+    def get_own_binary(self, key):
+        name, arch = key
+        return self.own_binaries[name].get(arch) if name in self.own_binaries else None
+
+    def set_own_binary(self, key, pkg):
+        name, arch = key
+        if pkg:
+            self.own_binaries[name][arch] = pkg
+        elif name in self.own_binaries:
+            self.own_binaries[name].pop(arch, None)
+            if not self.own_binaries[name]:
+                del self.own_binaries[name]
+
+    def set_own_source(self, name, pkg):
+        if pkg:
+            self.own_sources[name] = pkg
+        else:
+            self.own_sources.pop(name, None)
+
+    @staticmethod
+    def refresh_indexes(indexes, paths, read, lookup, update):
+        """
+        Re-read the index files whose stamp has changed, and patch the
+        packages they contain into the package map through lookup(key) and
+        update(key, package or None).  Returns the keys whose packages were
+        added, removed or changed version.
+        """
+
+        stamps = OrderedDict((path, cache.file_stamp(path)) for path in paths)
+        stale = [path for path in indexes if stamps.get(path) != indexes[path][0]]
+        fresh = [path for path in stamps if path not in indexes or path in stale]
+        if not stale and not fresh:
+            return set()
+
+        # Remember what was there before the stale files are re-read
+        previous = {}
+        for path in stale:
+            _, packages = indexes.pop(path)
+            for key in packages:
+                previous.setdefault(key, lookup(key))
+
+        for path in fresh:
+            stamp = cache.file_stamp(path)
+            packages = read(path)
+            indexes[path] = (stamp, packages)
+            for key in packages:
+                previous.setdefault(key, lookup(key))
+
+        # Keep the order of the files, which decides between duplicates
+        for path in sorted(indexes, key=stamps.keys().index):
+            indexes[path] = indexes.pop(path)
+
+        # Resolve every affected entry the way loading does: the last file
+        # listing it wins.  Architecture-independent binaries are listed in
+        # every Packages file, so this has to look at the unchanged files too.
+        for key in previous:
+            winner = None
+            for _, packages in indexes.itervalues():
+                winner = packages.get(key, winner)
+            if lookup(key) is not winner:
+                update(key, winner)
+
+        def version(pkg):
+            return pkg.version if pkg else None
+        return set(key for key, pkg in previous.iteritems() if version(pkg) != version(lookup(key)))
+
+    def refresh(self):
+        """
+        Bring the loaded indexes up to date with the repository, re-reading
+        only the index files which changed since they were loaded and
+        patching sources and binaries in place; the base distribution is
+        refreshed as well.  Returns the set of names of the source and the
+        set of names of binary packages which changed in this distribution.
+        """
+
+        if self.base:
+            self.base.refresh()
+
+        changed_sources = set()
+        changed_binaries = set()
+        if hasattr(self, 'own_sources'):
+            changed_sources = self.refresh_indexes(self.source_indexes, self.find_source_indexes(),
+                    self.read_source_index, self.own_sources.get, self.set_own_source)
+        if hasattr(self, 'own_binaries'):
+            changed_binaries = set(name for name, arch in self.refresh_indexes(self.binary_indexes,
+                    self.find_binary_indexes(), self.read_binary_index, self.get_own_binary, self.set_own_binary))
+        return changed_sources, changed_binaries
+
+    def prefill_control_cache(self, jobs=1):
+        """Read the binary architectures of all source packages in the
+        distribution which are not cached yet in parallel."""
+
+        prefill_control_cache(self.sources.itervalues(), jobs)
+
+    @tracing.traced("find out-of-date binaries")
+    def find_out_of_date_binaries(self, arches):
         """Find all packages for which there is a source package in the
-        repository, but not a binary one for a given architecture.  Returns
-        a list of source packages which need rebuilding."""
-
-        result = []
-        for name, src_pkg in self.sources.iteritems():
-            out_of_date = False
-            for binary, arches in src_pkg.get_binary_architectures().iteritems():
+        repository, but not an up-to-date binary one, for every one of the
+        given architectures in a single pass.  Returns { arch : [source
+        packages which need rebuilding] } map, and { arch : { source package
+        : (reason, binary package) } } map, where the reason is one of
+        'never built', 'missing architecture' and 'older version'."""
+
+        result = { arch : [] for arch in arches }
+        reasons = { arch : {} for arch in arches }
+        for name in self.sources:
+            for arch, reason in self.find_out_of_date_reasons(name, arches).iteritems():
+                result[arch].append(name)
+                reasons[arch][name] = reason
+
+        return result, reasons
+
+    def find_out_of_date_reasons(self, name, arches):
+        """Check whether the binaries of the named source package are up to
+        date for the given architectures.  Returns { arch : (reason,
+        binary package) } for the architectures where they are not, see
+        find_out_of_date_binaries()."""
+
+        src_pkg = self.sources[name]
+        tag = '~' + config.release_tags[self.release]
+        binary_arches = src_pkg.get_binary_architectures()
+        target_version = None
+        reasons = {}
+        for arch in arches:
+            reason = None
+            for binary, bin_arches in binary_arches.iteritems():
                 # Handle cases when package is not meant to be built
                 # in the given architecture
-                if arch == 'all' and 'all' not in arches:
+                if arch == 'all' and 'all' not in bin_arches:
                     continue
-                if arch != 'all' and not ('any' in arches or arch in arches):
+                if arch != 'all' and not ('any' in bin_arches or arch in bin_arches):
                     continue
 
                 # Package was never built
                 if binary not in self.binaries:
-                    out_of_date = True
+                    reason = 'never built', binary
                     break
 
                 # Package was not built for this archictecture
                 bin_pkgs = self.binaries[binary]
                 if arch not in bin_pkgs:
-                    out_of_date = True
+                    reason = 'missing architecture', binary
                     break
 
                 # Actually compare versions
                 bin_pkg = bin_pkgs[arch]
-                target_version = Version(src_pkg.version.full_version + '~' + config.release_tags[self.release])
+                if target_version is None:
+                    target_version = get_version(src_pkg.version.full_version + tag)
                 if bin_pkg.version > target_version:
                     # Circumvent edge cases of version comparison with manual-config packages
                     if not (name.startswith('debathena-manual-') and name.endswith('-config')):
                         raise BuildError("Package %s has version higher in binary than in source" % bin_pkg.name)
                 if target_version > bin_pkg.version:
-                    out_of_date = True
+                    reason = reason or ('older version', binary)
                     continue
 
-            if out_of_date:
-                result.append(name)
+            if reason:
+                reasons[arch] = reason
+
+        return reasons
+
+    def out_of_date_binaries(self, arch):
+        """Find all packages for which there is a source package in the
+        repository, but not a binary one for a given architecture.  Returns
+        a list of source packages which need rebuilding."""
 
-        return result
+        result, _ = self.find_out_of_date_binaries([arch])
+        return result[arch]
 
 def get_release(distribution):
     """For given release, returns (production, proposed, development)
-    tuple of distributions."""
+    tuple of distributions.  Proposed is stacked on top of production,
+    and development on top of proposed; none of them are loaded until
+    queried."""
 
     production = APTDistribution(distribution)
-    proposed = APTDistribution( (distribution, 'proposed') )
-    development = APTDistribution( (distribution, 'development') )
-    proposed.merge(production)
-    development.merge(proposed)
+    proposed = APTDistribution( (distribution, 'proposed'), base=production )
+    development = APTDistribution( (distribution, 'development'), base=proposed )
     return (production, proposed, development)
 
-def compare_against_git(apt_repo, update_all=False, checkout_cache=None):
+@tracing.traced("compare against git")
+def compare_against_git(apt_repo, update_all=False, checkout_cache=None, jobs=1):
     """Compare particular APT repo against the state of repositories in Git.
     If update_all is set to true, the repositories are fetched and reset to
-    remote state.
+    remote state.  Up to jobs checkouts are loaded in parallel.
 
     Returns a list of (package name, git version, APT version) tuples, where
     APT version is None if package is not in the repo, and git version is None
@@ -295,22 +756,24 @@ def compare_against_git(apt_repo, update_all=False, checkout_cache=None):
 
     result = []
     use_cache = isinstance(checkout_cache, dict)
-    for package in config.package_map:
+    packages = sorted(config.package_map)
+    to_load = [package for package in packages if not use_cache or package not in checkout_cache]
+    loaded = dict(zip(to_load, load_checkouts(to_load, full_clean=update_all, jobs=jobs)))
+    for package in packages:
         # Retrieve the checkout, possibly from cache, skip if invalid
-        try:
-            try:
-                checkout = checkout_cache[package]
-                if not checkout:
-                    continue
-            except (TypeError, KeyError):
-                checkout = PackageCheckout(package, full_clean=update_all)
-                if use_cache:
-                    checkout_cache[package] = checkout
-        except BuildError as err:
-            result.append( (package, None, err) )
+        if package in loaded:
+            checkout = loaded[package]
+            if isinstance(checkout, BuildError):
+                result.append( (package, None, checkout) )
+                checkout = None
             if use_cache:
-                checkout_cache[package] = None
-            continue
+                checkout_cache[package] = checkout
+            if not checkout:
+                continue
+        else:
+            checkout = checkout_cache[package]
+            if not checkout:
+                continue
 
         if apt_repo.release not in checkout.get_supported_releases():
             continue
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+"""
+Resolution of the order in which source packages have to be built.
+"""
+
+from common import BuildError
+import apt
+import config
+import tracing
+
+from collections import OrderedDict
+
+def union(s):
+    """
+    Given an iterator over sets, or objects which can be converted to sets,
+    create their union.
+    """
+
+    return frozenset().union(*s)
+
+def strongly_connected_components(roots, edges):
+    """
+    Find the strongly connected components of the graph reachable from the
+    specified roots, where edges is a function returning the successors of a
+    node.  Uses iterative Tarjan's algorithm, so it works on arbitrarily deep
+    graphs.  Components are returned as lists, each one after all components
+    reachable from it.
+    """
+
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in roots:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges(root)))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(edges(succ))))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    return components
+
+def is_cycle(component, edges):
+    return len(component) > 1 or component[0] in edges(component[0])
+
+def find_cycles(components, edges):
+    """Returns the sorted list of dependency cycles among the components,
+    each one being a sorted list of packages."""
+
+    return sorted(sorted(component) for component in components if is_cycle(component, edges))
+
+def format_cycles(cycles):
+    return '; '.join(', '.join(cycle) for cycle in cycles)
+
+def resolve_build_order_core(sources, binary_map, build_deps, bin_deps):
+    """
+    Given a list of source packages, map of source packages to
+    binary packages they provide, map of build dependencies and map
+    of dependencies of binaries, resolve the order in which the source
+    packages need to be built.  Dependencies name are of string -> set()
+    format.
+    """
+
+    # Compute { binary package : source package providing it } map
+    bin_inverse = dict()
+    for srcpkg, binpkgs in binary_map.iteritems():
+        for binpkg in binpkgs:
+            bin_inverse[binpkg] = srcpkg
+
+    def get_direct_bin_deps(binpkg):
+        return bin_deps.get(binpkg, ())
+
+    # Binary dependencies are expanded over the components of the binary
+    # dependency graph: since they come out after all components they depend
+    # on, the { binary package : source packages we intend building which
+    # provide it or any of its recursive dependencies } map can be filled
+    # in a single pass
+    roots = sorted(union(build_deps[srcpkg] for srcpkg in sources))
+    components = strongly_connected_components(roots, get_direct_bin_deps)
+    loops = find_cycles(components, get_direct_bin_deps)
+    if loops:
+        raise BuildError("Dependency loop detected between packages %s" % format_cycles(loops))
+
+    bin_deps_src = {}
+    for binpkg, in components:
+        bin_deps_src[binpkg] = union(bin_deps_src[dep] for dep in get_direct_bin_deps(binpkg)) | \
+                (frozenset([bin_inverse.get(binpkg)]) & sources)
+
+    # Construct { source package : source packages providing its binary dependencies } map
+    # The values are filtered to contain only source packages we actually intend building
+    build_deps_src = {
+            srcpkg : union(bin_deps_src[binpkg] for binpkg in build_deps[srcpkg])
+            for srcpkg in sources
+        }
+
+    # Heuristic: sort packages by the number of dependencies
+    working_set = sorted(sources, key=lambda pkg: (len(build_deps_src[pkg]), pkg))
+    position = { pkg : i for i, pkg in enumerate(working_set) }
+
+    # Packages used to be ordered by making passes over the working set, each
+    # pass adding the packages which have their dependencies already ordered,
+    # including the ones added earlier in the same pass.  Compute the pass in
+    # which every package would be added while sorting topologically, and
+    # order by it, which yields exactly the same order in linear time.
+    dependents = { pkg : [] for pkg in sources }
+    missing = {}
+    for pkg in working_set:
+        missing[pkg] = len(build_deps_src[pkg])
+        for dep in build_deps_src[pkg]:
+            dependents[dep].append(pkg)
+
+    ready = [pkg for pkg in working_set if not missing[pkg]]
+    build_pass = {}
+    while ready:
+        pkg = ready.pop()
+        build_pass[pkg] = max([build_pass[dep] + (position[dep] > position[pkg])
+                               for dep in build_deps_src[pkg]] or [0])
+        for dependent in dependents[pkg]:
+            missing[dependent] -= 1
+            if not missing[dependent]:
+                ready.append(dependent)
+
+    if len(build_pass) != len(working_set):
+        unresolved = [pkg for pkg in working_set if pkg not in build_pass]
+        get_deps = lambda pkg: build_deps_src[pkg]
+        cycles = find_cycles(strongly_connected_components(unresolved, get_deps), get_deps)
+        raise BuildError("Unable to resolve build dependencies, cycles between packages %s" % format_cycles(cycles))
+
+    # Order has (package, packages to build before it) format
+    order = OrderedDict()
+    for pkg in sorted(working_set, key=lambda pkg: (build_pass[pkg], position[pkg])):
+        order[pkg] = build_deps_src[pkg]
+
+    return order
+
+@tracing.traced("resolve build order")
+def resolve_build_order(distro, build_targets, arches, bindep_distro=None):
+    """Given the distribution and a list of build targets in it,
+    attempts to construct a list of tuples of format
+    (source_name, architecture) """
+
+    # List all source packages
+    sources = union(
+            {target for target in build_targets[arch]}
+            for arch in arches
+        )
+
+    # Create source -> provided binaries map
+    binary_map = {
+            srcpkg : frozenset(distro.sources[srcpkg].binaries)
+            for srcpkg in distro.sources
+        }
+
+    # Construct list of all known binaries
+    target_binaries = union(binary_map.values())
+
+    def simplify_deps(deps):
+        """
+        Flatten the complicated structure of package build-dependencies.  It takes
+        the horrible dict python-debian gives us and returns the set of all possible
+        dependencies.
+        """
+
+        # Note that here we transform "a or b" dependencies into "a and b"
+        # This might break in some cases, but in general provides us legitimate
+        # way to create a build ordering
+        names = union({d["name"] for d in dep} for dep in deps)
+        # Filter names to contain only known binaries
+        return names & target_binaries
+
+    # Construct { source package : direct binary dependencies } map
+    build_deps = {
+            srcpkg : simplify_deps(
+                distro.sources[srcpkg].relations['build-depends']
+            )
+            for srcpkg in distro.sources
+        }
+    # Construct { binary package : direct binary dependencies } map
+    bin_deps = {
+            binpkg : union(
+                simplify_deps(distro.binaries[binpkg][arch].relations['depends'])
+                for arch in distro.binaries[binpkg])
+            for binpkg in distro.binaries
+        }
+
+    # Mix-in binary dependencies information from other distribution if specified
+    if bindep_distro:
+        # Construct { binary package : direct binary dependencies } map for extra deps
+        extra = {
+                binpkg : union(
+                    simplify_deps(bindep_distro.binaries[binpkg][arch].relations['depends'])
+                    for arch in bindep_distro.binaries[binpkg]
+                )
+                for binpkg in bindep_distro.binaries
+            }
+        # Merge two dependency maps
+        extra.update(bin_deps)
+        bin_deps = extra
+
+    # Actually resolve everything
+    return resolve_build_order_core(sources, binary_map, build_deps, bin_deps)
+
+def create_build_schedule(distro, build_targets, arches, bindep_distro=None):
+    """
+    Given the distribution and a list of build targets in it, get the tuples
+    of package build commands in an appropriate order.  The tuples are of form
+    (repo, chroot, arch, source_name)
+    """
+
+    # If we are building -dev pocket, resolve build dependencies based on -proposed as well
+    if not bindep_distro and distro.pocket == 'development':
+        _, bindep_distro, _ = apt.get_release(distro.release)
+
+    order = resolve_build_order(distro, build_targets, arches, bindep_distro)
+    schedule = OrderedDict()
+    for package, deps in order.iteritems():
+        for arch in arches:
+            if package in build_targets[arch]:
+                key = (distro.name, distro.release, package, deps)
+                if key not in schedule:
+                    schedule[key] = list()
+                schedule[key].append(arch)
+
+    for archlist in schedule.values():
+        if 'all' in archlist:
+            archlist.remove('all')
+            if config.all_arch not in archlist:
+                archlist.append(config.all_arch)
+
+    return [k + (v,) for k, v in schedule.iteritems()]
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""
+Persistent on-disk cache for data which is expensive to recompute,
+such as parsed APT indexes.
+"""
+
+import config
+
+import cPickle as pickle
+import hashlib
+import os
+import os.path
+import tempfile
+
+def get_path(namespace, key):
+    digest = hashlib.sha1(key).hexdigest()
+    return os.path.join(config.cache_dir, namespace, digest)
+
+def load(namespace, key):
+    """Returns the value stored under the key, or None if there is none.
+    The cache is purely advisory, so a corrupted entry counts as missing."""
+
+    if not config.cache_dir:
+        return None
+
+    try:
+        with open(get_path(namespace, key), 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+def store(namespace, key, value):
+    """Atomically stores the value under the key.  Failure to write the
+    cache is silently ignored."""
+
+    if not config.cache_dir:
+        return
+
+    path = get_path(namespace, key)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(f.name, path)
+    except (IOError, OSError):
+        pass
+
+def remove(namespace, key):
+    try:
+        os.unlink(get_path(namespace, key))
+    except OSError:
+        pass
+
+def prune(namespace, is_stale):
+    """Removes all entries in the namespace for which is_stale(value) is
+    true, as well as unreadable ones.  Returns the number of entries
+    removed."""
+
+    if not config.cache_dir:
+        return 0
+
+    directory = os.path.join(config.cache_dir, namespace)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+
+    removed = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            stale = is_stale(value)
+        except Exception:
+            stale = True
+        if stale:
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+
+    return removed
+
+def file_stamp(path):
+    """Returns the tuple which changes whenever the file is modified."""
+
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def load_by_stamp(namespace, path, compute, version=0):
+    """Returns compute(path), reusing the on-disk result as long as the
+    file at path has not been changed since it was computed.  The version
+    should be changed whenever the format of the result changes."""
+
+    stamp = (version,) + file_stamp(path)
+    entry = load(namespace, path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+
+    value = compute(path)
+    store(namespace, path, (stamp, value))
+    return value
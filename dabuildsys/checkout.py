@@ -4,14 +4,31 @@
 Class which represents the source checkout of a package.
 """
 
+import cache
 import config
 import debian.changelog
 import debian.deb822
 import git
 import os.path
 import subprocess
+import threading
+import time
+import tracing
 
-from common import BuildError, extract_upstream_version
+from common import BuildError, LockTimeout, extract_upstream_version, locked, parallel_map
+from versions import get_version
+
+# Attributes stored in the metadata cache
+metadata_fields = ['native', 'name', 'released', 'version', 'released_version', 'build_for', 'no_build']
+
+# Statistics of the metadata cache use in this process; checkouts are
+# loaded from several threads, so they are updated under the lock
+metadata_cache_stats = { 'hits' : 0, 'misses' : 0 }
+metadata_cache_stats_lock = threading.Lock()
+
+def count_metadata_cache_use(result):
+    with metadata_cache_stats_lock:
+        metadata_cache_stats[result] += 1
 
 class PackageCheckout(git.GitRepository):
     def __init__(self, package, full_clean = False):
@@ -22,11 +39,60 @@ class PackageCheckout(git.GitRepository):
         self.dirname = package
 
         if full_clean:
-            self.git('fetch', '--all')
-            self.full_clean()
+            with locked('checkout-' + package):
+                self.git('fetch', '--all')
+                reset_repository(self)
 
-        self.determine_type()
-        self.load_changelog()
+        # Most checkouts are only loaded for their metadata, and many are
+        # loaded at once, so the cat-file coprocesses are not kept around
+        try:
+            self.load_metadata()
+        finally:
+            self.close_batch()
+
+    def get_metadata_key(self):
+        """Returns the heads of all branches the package metadata is
+        computed from."""
+
+        refs = self.get_refs()
+        return tuple(refs.get(ref) for ref in
+                ('refs/heads/master', 'refs/heads/debian', 'refs/remotes/%s/debian' % self.remote))
+
+    def load_metadata(self):
+        """Determine the package type and read the changelog and the control
+        file, reusing the results stored in the on-disk cache if none of the
+        branches has moved since."""
+
+        key = self.get_metadata_key()
+        entry = cache.load('checkout-metadata', self.root)
+        if entry and entry[0] == key:
+            count_metadata_cache_use('hits')
+            if isinstance(entry[1], str):
+                raise BuildError(entry[1])
+
+            for field, value in entry[1].iteritems():
+                setattr(self, field, value)
+            self.version_obj = get_version(self.version)
+            self.released_version_obj = get_version(self.released_version)
+            self.upstream_version = self.version_obj.upstream_version
+            return
+
+        count_metadata_cache_use('misses')
+        try:
+            self.determine_type()
+            self.load_changelog()
+        except BuildError as err:
+            cache.store('checkout-metadata', self.root, (self.get_metadata_key(), str(err)))
+            raise
+
+        try:
+            self.load_control()
+        except subprocess.CalledProcessError:
+            # Let get_supported_releases() report it when it is needed
+            pass
+
+        metadata = { field : getattr(self, field) for field in metadata_fields if hasattr(self, field) }
+        cache.store('checkout-metadata', self.root, (self.get_metadata_key(), metadata))
 
     def get_debian_file(self, filename):
         rev = self.get_rev('master' if self.native else 'debian')
@@ -46,12 +112,6 @@ class PackageCheckout(git.GitRepository):
 
         self.validate_common()
 
-    def full_clean(self):
-        self.clean()
-        self.remote_checkout('master')
-        if self.has_branch('debian'):
-            self.remote_checkout('debian')
-
     def validate_common(self):
         if not self.exists_debian_file('gbp.conf'):
             raise BuildError('Package does not contain gbp.conf')
@@ -89,11 +149,11 @@ class PackageCheckout(git.GitRepository):
         log = debian.changelog.Changelog(text)
 
         if log.distributions == 'unstable':
-            return log.package, True, log.version, log.version
+            return log.package, True, get_version(log.version), get_version(log.version)
         elif log.distributions == 'UNRELEASED':
             for change in log:
                 if change.distributions == 'unstable':
-                    return log.package, False, log.version, change.version
+                    return log.package, False, get_version(log.version), get_version(change.version)
             else:
                 raise BuildError("The package has no released versions")
         else:
@@ -109,17 +169,25 @@ class PackageCheckout(git.GitRepository):
         else:
             cur = self.get_rev('debian')
             master = self.get_rev('master')
+
+        # The walk is done over commit hashes using the in-memory graph, and
+        # the changelog is only parsed again when its blob changes
+        graph = self.load_commit_graph()
+        cur = cur.hash
         prev = None
         found = False
+        log_id = None
         while True:
             # Read the changelog of current revisions
-            try:
-                log = debian.changelog.Changelog(cur.read_file('debian/changelog'))
-            except subprocess.CalledProcessError:
+            changelog_id = graph.get_file_id(cur, 'debian/changelog')
+            if changelog_id is None:
                 if found:
                     break
                 else:
                     return None
+            if changelog_id != log_id:
+                log = debian.changelog.Changelog(self.read_object(changelog_id, 'blob'))
+                log_id = changelog_id
 
             # Check if the current revision is matching
             if log.distributions == 'unstable' and str(log.full_version) == version and log.upstream_version == upstream_version:
@@ -132,21 +200,22 @@ class PackageCheckout(git.GitRepository):
 
             # Move to next parent revision
             prev = cur
-            parents = cur.parents
+            parents = graph.parents[cur] if cur in graph else self.get_rev(cur).parents
             if len(parents) == 0:
                 # Not found
                 return None
             elif len(parents) == 1:
-                cur = self.get_rev(parents[0])
+                cur = parents[0]
             else:
-                debian_parents = [rev for rev in map(self.get_rev, parents) if not rev < master]
+                debian_parents = [rev for rev in parents
+                        if rev == master.hash or not self.is_ancestor(rev, master.hash)]
                 if len(debian_parents) != 1:
-                    raise BuildError("Debian revision search breakdown at revision %s" % str(cur))
-                cur = self.get_rev(debian_parents[0])
+                    raise BuildError("Debian revision search breakdown at revision %s" % cur)
+                cur = debian_parents[0]
 
         # If we are here, it means that we are past the part of the history where
         # the version matched our search conditions
-        deb_rev = prev
+        deb_rev = self.get_rev(prev)
         if self.native:
             return deb_rev, deb_rev
 
@@ -178,8 +247,9 @@ class PackageCheckout(git.GitRepository):
             orig = "%s_%s.orig.tar.gz" % (self.name, extract_upstream_version(version))
             return [s % package_name for s in ["%s.dsc", "%s.debian.tar.xz"] + extras] + [orig]
 
-    def get_supported_releases(self):
-        """Returns the list of releases for which package is still built."""
+    def load_control(self):
+        """Read the fields of the control file which determine the releases
+        package is built for."""
 
         # FIXME: this code should only parse the prologue of the file
         # Unfortunately, the fields in question were to this day only
@@ -189,31 +259,166 @@ class PackageCheckout(git.GitRepository):
         for block in debian.deb822.Deb822.iter_paragraphs(self.get_debian_file('control').split("\n")):
             control.update(block)
 
+        self.build_for = control.get('X-Debathena-Build-For')
+        self.no_build = control.get('X-Debathena-No-Build')
+
+    def get_supported_releases(self):
+        """Returns the list of releases for which package is still built."""
+
+        if not hasattr(self, 'build_for'):
+            self.load_control()
+
         releases = set(config.releases)
-        if 'X-Debathena-Build-For' in control:
-            releases &= set(control['X-Debathena-Build-For'].split(' '))
+        if self.build_for is not None:
+            releases &= set(self.build_for.split(' '))
 
-        if 'X-Debathena-No-Build' in control:
-            releases -= set(control['X-Debathena-No-Build'].split(' '))
+        if self.no_build is not None:
+            releases -= set(self.no_build.split(' '))
 
         return list(releases)
 
-package_name_cache = {}
+def reset_repository(repo):
+    """Reset the package repository to the state of the remote."""
 
-def lookup_by_package_name(name):
-    global package_name_cache
+    repo.clean()
+    repo.remote_checkout('master')
+    if repo.has_branch('debian'):
+        repo.remote_checkout('debian')
+
+@tracing.traced("update checkouts")
+def update_checkouts(packages, jobs=1, timeout=None):
+    """Fetch the repositories of specified packages and reset them to the
+    state of the remote, using up to the specified number of threads.  If
+    timeout is set, the update of each repository is aborted after that
+    many seconds.  Returns the list of (package, seconds taken, error) tuples,
+    where error is None if the update succeeded."""
+
+    def update(package):
+        start = time.time()
+        repo = git.GitRepository(config.package_map[package])
+        if timeout:
+            repo.deadline = start + timeout
+
+        try:
+            with locked('checkout-' + package, deadline=repo.deadline):
+                repo.git('fetch', '--all')
+                reset_repository(repo)
+            error = None
+        except (subprocess.CalledProcessError, OSError, LockTimeout) as err:
+            error = err
+
+        return package, time.time() - start, error
+
+    return parallel_map(update, [p for p in packages if p in config.package_map], jobs)
+
+def print_update_summary(results):
+    """Print the report of update_checkouts()."""
+
+    results = sorted(results, key=lambda (package, elapsed, error): (-elapsed, package))
+    failures = [result for result in results if result[2]]
+    total = sum(elapsed for package, elapsed, error in results)
+
+    print "Updated %i repositories (%.1f seconds of work):" % (len(results) - len(failures), total)
+    for package, elapsed, error in results[:10]:
+        print "* %s: %.1fs" % (package, elapsed)
+    if len(results) > 10:
+        print "* ... %i more" % (len(results) - 10)
+    print
+
+    if failures:
+        print "== Failed to update =="
+        for package, elapsed, error in failures:
+            if getattr(error, 'returncode', None) == 124:
+                reason = "timed out"
+            else:
+                lines = (getattr(error, 'output', None) or str(error)).strip().split("\n")
+                reason = ([line for line in lines if line.startswith('fatal:')] + lines)[0]
+            print "* %s after %.1fs (%s)" % (package, elapsed, reason)
+        print
+
+@tracing.traced("load checkouts")
+def load_checkouts(packages, full_clean=False, jobs=1, catch=BuildError):
+    """Create the checkouts for the specified packages, using up to the
+    specified number of threads.  Returns a list in the same order as
+    packages; if loading a checkout raises an exception of a type specified
+    in catch, the exception is placed into the list instead."""
+
+    def load(package):
+        try:
+            return PackageCheckout(package, full_clean=full_clean)
+        except catch as err:
+            return err
+
+    return parallel_map(load, packages, jobs)
+
+class PackageNameIndex(object):
+    """Maps the source package names to the names of checkout directories
+    and back.  The index is persisted in the on-disk cache, and the entry for
+    a repository is recomputed only when its debian or master branch moves;
+    validating it does not require running git."""
+
+    def __init__(self, package_map=None, jobs=1):
+        if package_map is None:
+            package_map = config.package_map
+
+        entries = cache.load('package-names', config.package_root) or {}
+        valid = {}
+        for dirname, path in package_map.iteritems():
+            entry = entries.get(dirname)
+            if entry and entry[:2] == (path, self.get_key(path)):
+                valid[dirname] = entry
 
-    if not package_name_cache:
-        for package_dirname, package_path in config.package_map.iteritems():
-            repo = git.GitRepository(package_path)
+        stale = sorted(set(package_map) - set(valid))
+        valid.update(zip(stale, parallel_map(lambda dirname: self.compute_entry(package_map[dirname]), stale, jobs)))
+        if valid != entries:
+            cache.store('package-names', config.package_root, valid)
+
+        self.names = { dirname : entry[2] for dirname, entry in valid.iteritems() if entry[2] }
+        self.dirnames = { name : dirname for dirname, name in sorted(self.names.iteritems()) }
+
+    @staticmethod
+    def get_key(path):
+        repo = git.GitRepository(path)
+        return (repo.read_ref('refs/heads/debian'), repo.read_ref('refs/heads/master'))
+
+    @classmethod
+    def compute_entry(cls, path):
+        key = cls.get_key(path)
+        repo = git.GitRepository(path)
+        for ref in ('refs/heads/debian', 'refs/heads/master'):
             try:
-                changelog_text = repo.git('cat-file', 'blob', 'refs/heads/debian:debian/changelog')
-            except:
-                try:
-                    changelog_text = repo.git('cat-file', 'blob', 'refs/heads/master:debian/changelog')
-                except:
-                    continue
-            package_name, _ = changelog_text.split(' ', 1)
-            package_name_cache[package_name] = package_dirname
-
-    return package_name_cache.get(name)
+                changelog_text = repo.git('cat-file', 'blob', '%s:debian/changelog' % ref)
+                break
+            except subprocess.CalledProcessError:
+                pass
+        else:
+            return (path, key, None)
+
+        package_name, _ = changelog_text.split(' ', 1)
+        return (path, key, package_name)
+
+    def get_dirname(self, name):
+        """Returns the checkout directory name for the source package name."""
+
+        return self.dirnames.get(name)
+
+    def get_name(self, dirname):
+        """Returns the source package name for the checkout directory name."""
+
+        return self.names.get(dirname)
+
+package_name_index = None
+
+def get_package_name_index(jobs=1):
+    """Returns the index of package names for config.package_map, building
+    it on first use with up to the specified number of threads."""
+
+    global package_name_index
+
+    if not package_name_index:
+        package_name_index = PackageNameIndex(jobs=jobs)
+
+    return package_name_index
+
+def lookup_by_package_name(name):
+    return get_package_name_index().get_dirname(name)
@@ -1,29 +1,196 @@
 #!/usr/bin/python
 
 import config
+from versions import get_version
 
-from debian.debian_support import Version
+from multiprocessing.pool import Pool, ThreadPool
+import contextlib
 import errno
+import fcntl
 import os
+import threading
+import time
 
 class BuildError(Exception):
     pass
 
 def extract_upstream_version(version):
-    if not isinstance(version, Version):
-        version = Version(version)
-    return version.upstream_version
+    return get_version(version).upstream_version
 
-def claim_lock():
+def parallel_map(func, items, jobs=1, processes=False):
+    """Apply func to every item using up to the specified number of threads.
+    The results are returned in the order of items.  If func raises, the
+    exception is propagated to the caller.  If processes is set, worker
+    processes are used instead, which is needed for CPU-bound work; func,
+    items and results then have to be picklable."""
+
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    pool = (Pool if processes else ThreadPool)(min(jobs, len(items)))
     try:
-        fd = os.open(config.lock_file_path, os.O_CREAT | os.O_EXCL)
-        os.close(fd)
-        return True
-    except OSError as err:
-        if err.errno == errno.EEXIST:
+        # A timeout is passed so that KeyboardInterrupt is delivered
+        return pool.map_async(func, items, chunksize=1).get(2 ** 31)
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Locks held by this process, as { name : (file descriptor, exclusive,
+# thread) }, where thread is the ident of the thread which claimed it
+held_locks = {}
+held_locks_lock = threading.Lock()
+
+# fcntl locks belong to the process and do not exclude its threads from
+# each other, so every name also has a threading lock, held by the thread
+# which claimed the named lock
+thread_locks = {}
+
+def get_lock_path(name):
+    """Returns the file used for the named lock.  The APT repository lock
+    uses DEBATHENA_LOCK_FILE itself, the other locks live next to it."""
+
+    if name == 'apt':
+        return config.lock_file_path
+    return "%s.%s" % (config.lock_file_path, name)
+
+def holds_lock(name):
+    """Checks whether the named lock is held by the current thread."""
+
+    held = held_locks.get(name)
+    return held is not None and held[2] == threading.current_thread().ident
+
+def set_lock_mode(fd, exclusive, blocking):
+    """Lock the file shared or exclusive.  Returns False if it is locked by
+    another process and blocking is not set."""
+
+    mode = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB)
+    try:
+        fcntl.lockf(fd, mode)
+    except IOError as err:
+        if err.errno in (errno.EACCES, errno.EAGAIN):
             return False
-        else:
-            raise
+        raise
+
+    if exclusive:
+        os.ftruncate(fd, 0)
+        os.write(fd, "%i\n" % os.getpid())
+    return True
+
+def claim_lock(name='apt', exclusive=True, blocking=False):
+    """
+    Take the named lock, shared or exclusive.  Read-only users of the APT
+    repository take the 'apt' lock shared, anything running reprepro takes
+    it exclusive; git checkouts are guarded by 'checkout-<package>' locks.
+    A lock already held by this thread is converted to the requested mode.
+    Returns False if the lock is held by another process or another thread
+    of this one, unless blocking is set, in which case it waits for it.
+
+    The locks are fcntl locks, so the kernel drops them when their owner
+    dies and a lock file left behind by a crashed process never needs to be
+    removed by hand.  The exclusive owner writes its PID into the file so
+    that it can be named by lock_busy_message().
+    """
+
+    if holds_lock(name):
+        return convert_lock(name, exclusive, blocking)
+
+    with held_locks_lock:
+        thread_lock = thread_locks.setdefault(name, threading.Lock())
+    if not thread_lock.acquire(blocking):
+        return False
+
+    fd = None
+    try:
+        fd = os.open(get_lock_path(name), os.O_RDWR | os.O_CREAT, 0666)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        if set_lock_mode(fd, exclusive, blocking):
+            with held_locks_lock:
+                held_locks[name] = (fd, exclusive, threading.current_thread().ident)
+            return True
+    except:
+        if fd is not None:
+            os.close(fd)
+        thread_lock.release()
+        raise
+
+    os.close(fd)
+    thread_lock.release()
+    return False
+
+def convert_lock(name='apt', exclusive=True, blocking=True):
+    """Convert the named lock held by this process to shared or exclusive,
+    whichever thread claimed it; the threads sharing the lock this way have
+    to coordinate with each other.  Returns False if the conversion would
+    have to wait for another process and blocking is not set."""
+
+    fd, was_exclusive, thread = held_locks[name]
+    if was_exclusive and not exclusive:
+        os.ftruncate(fd, 0)
+    if not set_lock_mode(fd, exclusive, blocking):
+        return False
+    with held_locks_lock:
+        held_locks[name] = (fd, exclusive, thread)
+    return True
+
+def release_lock(name='apt'):
+    with held_locks_lock:
+        fd, exclusive, _ = held_locks.pop(name)
+        thread_lock = thread_locks[name]
+    if exclusive:
+        os.ftruncate(fd, 0)
+    os.close(fd)
+    thread_lock.release()
+
+def release_all_locks():
+    for name in list(held_locks):
+        release_lock(name)
+
+class LockTimeout(BuildError):
+    pass
+
+@contextlib.contextmanager
+def locked(name, exclusive=True, deadline=None):
+    """Hold the named lock for the duration of the with block, waiting for
+    it if necessary, including for other threads holding it.  If deadline
+    (as in time.time()) is set, LockTimeout is raised if the lock is not
+    free by then.  A lock already held by this thread is left alone."""
+
+    if holds_lock(name):
+        yield
+        return
+
+    if deadline is None:
+        claim_lock(name, exclusive, blocking=True)
+    else:
+        while not claim_lock(name, exclusive):
+            if time.time() >= deadline:
+                raise LockTimeout("Timed out waiting for the %s lock" % name)
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        release_lock(name)
+
+def get_lock_owner(name='apt'):
+    """Returns the PID of the live process holding the named lock
+    exclusively, or None if there is none or it is not known."""
+
+    try:
+        with open(get_lock_path(name), 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (IOError, ValueError):
+        return None
+    except OSError as err:
+        if err.errno != errno.EPERM:
+            return None
+    return pid
 
-def release_lock():
-    os.unlink(config.lock_file_path)
+def lock_busy_message(name='apt'):
+    if name in held_locks:
+        return "The %s lock is held by another thread of this process; unable to proceed" % name
+    pid = get_lock_owner(name)
+    if pid and pid != os.getpid():
+        return "The %s lock is held by process %i; unable to proceed" % (name, pid)
+    return "The %s lock is in place; unable to proceed" % name
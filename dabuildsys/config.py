@@ -28,9 +28,15 @@ release_tags = dict(debian_tags.items() + ubuntu_tags.items())
 package_search_paths = ['athena/*', 'debathena/*', 'third/*']
 package_root = os.environ['DEBATHENA_CHECKOUT_HOME']
 
-package_paths = [ os.path.join(package_root, path) for path in package_search_paths ]
-package_paths = sum(map(glob, package_paths), [])
-package_map = { path.split('/')[-1] : path for path in package_paths }
+def find_packages():
+    """Returns the { checkout directory name : path } map of all package
+    checkouts."""
+
+    package_paths = [ os.path.join(package_root, path) for path in package_search_paths ]
+    package_paths = sum(map(glob, package_paths), [])
+    return { path.split('/')[-1] : path for path in package_paths }
+
+package_map = find_packages()
 
 arches = ['i386', 'amd64', 'armel', 'armhf', 'sparc']
 builders = {
@@ -56,7 +62,16 @@ orig_tarball_dir = os.environ['DEBATHENA_ORIG_DIR']
 apt_root_dir = os.environ['DEBATHENA_APT_DIR']
 lock_file_path = os.environ['DEBATHENA_LOCK_FILE']
 setup_hook_path = os.environ['DEBATHENA_SETUP_HOOK']
+# Set to an empty string to disable on-disk caching
+cache_dir = os.environ.get('DEBATHENA_CACHE_DIR', os.path.expanduser('~/.cache/dabuildsys'))
 
 upstream_tarball_chroot = 'upstream-tarball-area'
 
 release_tag_key = "0D8A9E8F"
+# Upper bound on the size of built source packages kept for reuse, in bytes
+source_cache_size = int(os.environ.get('DEBATHENA_SOURCE_CACHE_SIZE', 2 * 1024 ** 3))
+# Set to a file name to record a trace of subprocesses and phases into it
+trace_path = os.environ.get('DEBATHENA_TRACE', '')
+# Unix socket of the planner daemon (daplanner); set to an empty string to
+# always compute the plans in-process
+planner_socket_path = os.environ.get('DEBATHENA_PLANNER_SOCKET', lock_file_path + '.planner')
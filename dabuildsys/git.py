@@ -4,42 +4,350 @@
 Utility classes for working with Git.
 """
 
+import tracing
+
 import re
 import os
 import os.path
 import subprocess
 import tempfile
+import time
 
 def flip(t):
     a, b = t
     return b, a
 
+class GitBatch(object):
+    """A long-lived `git cat-file --batch` (or `--batch-check`) coprocess,
+    which allows looking up many objects without forking git for each one."""
+
+    def __init__(self, root, mode='--batch'):
+        self.mode = mode
+        self.process = subprocess.Popen(['git', 'cat-file', mode],
+                stdin = subprocess.PIPE, stdout = subprocess.PIPE, cwd = root,
+                # Do not hold on to the pipes of processes started by other threads
+                close_fds = True)
+
+    def query(self, name):
+        """Returns (hash, type, contents) tuple for the named object; contents
+        is None in --batch-check mode.  Raises CalledProcessError if the object
+        does not exist, the same way `git cat-file` would."""
+
+        if '\n' in name:
+            raise ValueError("Object name %r cannot be passed over a pipe" % name)
+
+        self.process.stdin.write(name + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise IOError("git cat-file %s exited unexpectedly" % self.mode)
+
+        header = header.rstrip('\n')
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            raise subprocess.CalledProcessError(128, ['git', 'cat-file', self.mode, name], header)
+
+        obj, objtype, size = header.split(' ')
+        if self.mode != '--batch':
+            return obj, objtype, None
+
+        contents = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)
+        return obj, objtype, contents
+
+    def close(self):
+        """Stop the coprocess and reap it.  It is terminated rather than left
+        to exit at the end of input, since processes started meanwhile by
+        other threads may have inherited its stdin."""
+
+        self.process.stdin.close()
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        self.process.wait()
+
+class CommitGraph(object):
+    """In-memory parent graph of every commit reachable from the refs of a
+    repository, loaded from a single `git rev-list` invocation, which answers
+    ancestry queries without starting any further processes."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.parents = {}
+        self.children = None
+        self.ancestor_cache = {}
+        self.file_ids = {}
+
+        for line in repo.git('rev-list', '--parents', '--all').splitlines():
+            commits = line.split()
+            self.parents[commits[0]] = commits[1:]
+
+    def __contains__(self, commit):
+        return commit in self.parents
+
+    def get_ancestors(self, commit):
+        """Returns the set of all ancestors of the commit, including itself."""
+
+        try:
+            return self.ancestor_cache[commit]
+        except KeyError:
+            pass
+
+        ancestors = set()
+        stack = [commit]
+        while stack:
+            cur = stack.pop()
+            if cur not in ancestors:
+                ancestors.add(cur)
+                # Parents missing from the graph (shallow history) are skipped
+                stack.extend(self.parents.get(cur, []))
+
+        # Only the last few sets are kept, since those can be large
+        if len(self.ancestor_cache) >= 4:
+            self.ancestor_cache.clear()
+        self.ancestor_cache[commit] = ancestors
+        return ancestors
+
+    def is_ancestor(self, older, newer):
+        return older in self.get_ancestors(newer)
+
+    def get_merge_bases(self, commit1, commit2):
+        """Returns the best common ancestors of two commits, that is, common
+        ancestors which are not ancestors of any other common ancestor."""
+
+        if self.children is None:
+            self.children = {}
+            for commit, parents in self.parents.iteritems():
+                for parent in parents:
+                    self.children.setdefault(parent, []).append(commit)
+
+        # Every commit between two common ancestors is a common ancestor
+        # itself, so it is enough to check the immediate children
+        common = self.get_ancestors(commit1) & self.get_ancestors(commit2)
+        return sorted(commit for commit in common
+                if not any(child in common for child in self.children.get(commit, [])))
+
+    def get_file_id(self, commit, path):
+        """Returns the id of the blob at the path in the commit, or None if
+        there is no such file."""
+
+        key = (commit, path)
+        try:
+            return self.file_ids[key]
+        except KeyError:
+            pass
+
+        name = "%s:%s" % key
+        try:
+            result = self.repo.query_batch('--batch-check', name)
+            if result:
+                file_id, objtype = result[0:2]
+            else:
+                file_id = self.repo.git('rev-parse', name)
+                objtype = self.repo.get_object_type(file_id)
+            if objtype != 'blob':
+                file_id = None
+        except subprocess.CalledProcessError:
+            file_id = None
+
+        self.file_ids[key] = file_id
+        return file_id
+
 class GitRepository(object):
     # Currently hard-coded, but the idea is to have enough flexibility to make
     # the class work with other remotes
     remote = 'origin'
 
+    # Serve object lookups from a cat-file coprocess instead of forking git
+    # each time.  Set DEBATHENA_NO_GIT_BATCH to disable.
+    use_batch = 'DEBATHENA_NO_GIT_BATCH' not in os.environ
+
+    # Total number of processes started, used for benchmarking
+    forks = 0
+
+    # If set, the time (as in time.time()) after which commands are killed
+    deadline = None
+
+    # git subcommands which never modify refs; all others invalidate the
+    # cached snapshot of refs
+    read_only_commands = frozenset(['archive', 'cat-file', 'checkout-index', 'clean',
+        'ls-remote', 'merge-base', 'read-tree', 'rev-list', 'rev-parse', 'show-ref'])
+
     def __init__(self, root):
         self.root = root
         self.rev_cache = {}
+        self.batches = {}
+        self.refs = None
+        self.remote_refs = None
+        self.commit_graph = None
 
     def cmd(self, *args, **kwargs):
         """Invoke a shell command in the specified repository."""
 
+        GitRepository.forks += 1
         cmd = list(args)
-        return subprocess.check_output(cmd, stderr = subprocess.STDOUT, cwd = self.root, **kwargs).strip()
+        label = ' '.join(cmd[:2]) if cmd[0] == 'git' else cmd[0]
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise subprocess.CalledProcessError(124, cmd, "Deadline expired before command was started")
+            # timeout(1) treats 0 as no timeout at all
+            cmd = ['timeout', '%.1f' % max(remaining, 0.1)] + cmd
+        return tracing.check_output(cmd, label, stderr = subprocess.STDOUT, cwd = self.root, **kwargs).strip()
 
     def git(self, *args, **kwargs):
         """Invoke git(1) for the specified repository."""
 
         args_flattened = tuple(arg.hash if isinstance(arg, GitCommit) else arg for arg in args)
-        return self.cmd(*(('git',) + args_flattened), **kwargs)
+        try:
+            return self.cmd(*(('git',) + args_flattened), **kwargs)
+        finally:
+            if args_flattened[0] not in self.read_only_commands:
+                self.invalidate_refs(remote=args_flattened[0] == 'push')
+
+    def invalidate_refs(self, remote=False):
+        """Forget the cached refs, and revisions looked up by name.  Called
+        after every operation which may change refs."""
+
+        self.refs = None
+        self.commit_graph = None
+        self.rev_cache = { name : rev for name, rev in self.rev_cache.iteritems() if name == rev.hash }
+        if remote:
+            self.remote_refs = None
+
+    def get_batch(self, mode):
+        """Returns the cat-file coprocess in specified mode, starting it if
+        necessary.  Returns None if batch mode is disabled or unavailable."""
+
+        if not self.use_batch:
+            return None
+
+        if mode not in self.batches:
+            try:
+                self.batches[mode] = GitBatch(self.root, mode)
+                GitRepository.forks += 1
+            except OSError:
+                self.use_batch = False
+                return None
+
+        return self.batches[mode]
+
+    def close_batch(self):
+        """Stop the cat-file coprocesses.  They are started again if another
+        object is looked up afterwards."""
+
+        batches, self.batches = self.batches, {}
+        for batch in batches.values():
+            batch.close()
+
+    def query_batch(self, mode, name):
+        """Query the coprocess, falling back to the regular path (by returning
+        None) if it is not available or has died."""
+
+        batch = self.get_batch(mode)
+        if not batch:
+            return None
+
+        try:
+            return batch.query(name)
+        except ValueError:
+            # The name cannot be sent over the pipe
+            return None
+        except IOError:
+            # The coprocess died; do not attempt to use it again
+            self.close_batch()
+            self.use_batch = False
+            return None
+
+    def resolve(self, name):
+        """Returns the hash of the named object, as `git rev-parse` would."""
+
+        result = self.query_batch('--batch-check', name)
+        if result:
+            return result[0]
+
+        return self.git('rev-parse', name)
+
+    def read_object(self, name, objtype):
+        """Returns the contents of the named object peeled to the specified
+        type, as `git cat-file <type> <name>` would."""
+
+        result = self.query_batch('--batch', name)
+        if result and result[1] != objtype:
+            result = self.query_batch('--batch', '%s^{%s}' % (name, objtype))
+        if result:
+            return result[2].strip()
+
+        return self.git('cat-file', objtype, name)
+
+    def object_exists(self, name, objtype):
+        """Checks if the named object exists and is of the specified type."""
+
+        try:
+            result = self.query_batch('--batch-check', name)
+            if result:
+                return result[1] == objtype
+
+            return self.get_object_type(name) == objtype
+        except subprocess.CalledProcessError:
+            return False
 
     def get_refs(self, remote=False):
+        """Returns the { ref : hash } map of local or remote refs.  The result
+        is cached until the refs are modified through this object."""
+
+        if remote and self.remote_refs is not None:
+            return self.remote_refs
+        if not remote and self.refs is not None:
+            return self.refs
+
         output = self.git('ls-remote', self.remote) if remote else self.git('show-ref')
         lines = output.splitlines()
         lines = map(str.strip, lines)
-        return dict(flip(re.split(r"\s+", line, 2)) for line in lines if line)
+        refs = dict(flip(re.split(r"\s+", line, 2)) for line in lines if line)
+        if remote:
+            self.remote_refs = refs
+        else:
+            self.refs = refs
+        return refs
+
+    def get_git_dir(self):
+        git_dir = os.path.join(self.root, '.git')
+        if os.path.isfile(git_dir):
+            with open(git_dir) as f:
+                git_dir = os.path.join(self.root, f.read().strip().split(' ', 1)[1])
+
+        return git_dir
+
+    def read_ref(self, ref):
+        """Returns the hash the ref points to, or None if there is no such ref.
+        Unlike the rest of the class, this reads the repository files directly
+        instead of invoking git, so it is cheap enough to validate caches."""
+
+        git_dir = self.get_git_dir()
+        try:
+            with open(os.path.join(git_dir, ref)) as f:
+                value = f.read().strip()
+            if value.startswith('ref: '):
+                return self.read_ref(value[5:])
+            return value
+        except IOError:
+            pass
+
+        try:
+            with open(os.path.join(git_dir, 'packed-refs')) as f:
+                for line in f:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    obj, name = line.strip().split(' ', 1)
+                    if name == ref:
+                        return obj
+        except IOError:
+            pass
+
+        return None
 
     def has_branch(self, name, local_only = False):
         local_ref = 'refs/heads/%s' % name
@@ -68,13 +376,33 @@ class GitRepository(object):
         self.clean()
         self.git('checkout', '-B', branch, '%s/%s' % (self.remote, branch))
 
+    def load_commit_graph(self):
+        """Loads the commit graph of the repository, which is then used to
+        answer ancestry queries until the refs change."""
+
+        if self.commit_graph is None:
+            self.commit_graph = CommitGraph(self)
+        return self.commit_graph
+
+    def in_commit_graph(self, *hashes):
+        return self.commit_graph is not None and all(h in self.commit_graph for h in hashes)
+
     def get_common_ancestor(self, rev1, rev2):
+        if self.in_commit_graph(rev1.hash, rev2.hash):
+            bases = self.commit_graph.get_merge_bases(rev1.hash, rev2.hash)
+            # Leave picking among several merge bases to git
+            if len(bases) == 1:
+                return GitCommit(self, bases[0])
+
         return GitCommit(self, self.git('merge-base', rev1, rev2))
 
     def is_ancestor(self, rev_older, rev_newer):
         """Checks if the rev_older is an ancestor of rev_newer. Returns true
         in case if two revisions are equal."""
 
+        if self.in_commit_graph(rev_older, rev_newer):
+            return self.commit_graph.is_ancestor(rev_older, rev_newer)
+
         try:
             return self.git('merge-base', rev_older, rev_newer) == rev_older
         except subprocess.CalledProcessError as err:
@@ -91,6 +419,7 @@ class GitRepository(object):
             rev = rev.hash
 
         self.cmd('pristine-tar', 'commit', tarfile, rev)
+        self.invalidate_refs()
 
     def export_tarball(self, tarfile):
         self.cmd('pristine-tar', 'checkout', tarfile)
@@ -100,7 +429,7 @@ class GitRepository(object):
 
     def get_tarball_tree(self, tarfile):
         try:
-            return self.git('cat-file', 'blob', "refs/heads/pristine-tar:%s.id" % tarfile)
+            return self.read_object("refs/heads/pristine-tar:%s.id" % tarfile, 'blob')
         except subprocess.CalledProcessError as err:
             return None
 
@@ -110,9 +439,9 @@ class GitRepository(object):
 class GitCommit(object):
     def __init__(self, repo, name):
         self.repo = repo
-        self.hash = repo.git('rev-parse', name)
+        self.hash = repo.resolve(name)
 
-        self.desc = repo.git('cat-file', 'commit', self.hash).strip()
+        self.desc = repo.read_object(self.hash, 'commit')
 
         lines = self.desc.split("\n")
         seperator = lines.index('')
@@ -128,18 +457,19 @@ class GitCommit(object):
 
     def read_file(self, path):
         pathspec = "%s:%s" % (self.hash, path)
-        return self.repo.git('cat-file', 'blob', pathspec)
+        return self.repo.read_object(pathspec, 'blob')
 
     def file_exists(self, path):
-        try:
-            self.read_file(path)
-        except subprocess.CalledProcessError:
-            return False
+        return self.repo.object_exists("%s:%s" % (self.hash, path), 'blob')
 
-        return True
+    def extract_tree(self, path, indexfile=None):
+        """Check out the tree into the specified directory, using a temporary
+        index file (or the one specified) so that the repository itself is
+        not touched."""
 
-    def extract_tree(self, path):
-        indexfile = tempfile.mktemp()
+        remove_index = indexfile is None
+        if remove_index:
+            indexfile = tempfile.mktemp()
 
         env = os.environ.copy()
         env['GIT_WORK_TREE'] = path
@@ -148,7 +478,8 @@ class GitCommit(object):
         self.repo.git('read-tree', self.tree, env=env)
         self.repo.git('checkout-index', '-a', env=env)
 
-        os.unlink(indexfile)
+        if remove_index:
+            os.unlink(indexfile)
 
     def annotated_tag(self, name, message, key=None):
         if key:
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+"""
+Planning queries (status of a release, out-of-date binaries, build order),
+answered either by the daplanner daemon, which keeps the APT distributions
+and package checkouts loaded between queries, or in-process when no daemon
+is running.  Both ways run the same code, so the answers are identical.
+
+The daemon does not watch the filesystem in the background; instead, every
+query first checks the index files and the branch heads for changes, which
+only costs a few stat() calls, and re-reads only what has changed.
+"""
+
+from common import BuildError, locked
+import apt
+import buildorder
+import checkout
+import config
+
+import SocketServer
+import errno
+import json
+import os
+import os.path
+import socket
+import sys
+
+class PlannerState(object):
+    """
+    APT distributions and package checkouts loaded so far.  A fresh state is
+    used for every in-process query; the daemon keeps one for its lifetime.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.distributions = {}
+        self.checkout_cache = {}
+        self.checkout_keys = {}
+
+    def get_distribution(self, name):
+        """Returns APTDistribution(name), brought up to date with the index
+        files if it was loaded before."""
+
+        if name in self.distributions:
+            self.distributions[name].refresh()
+        else:
+            self.distributions[name] = apt.APTDistribution(name)
+        return self.distributions[name]
+
+    def get_release(self, release):
+        """Returns the result of apt.get_release(release), brought up to
+        date the same way."""
+
+        key = ('release', release)
+        if key in self.distributions:
+            # Refreshing development refreshes the pockets below it too
+            self.distributions[key][2].refresh()
+        else:
+            self.distributions[key] = apt.get_release(release)
+        return self.distributions[key]
+
+    def refresh_checkouts(self):
+        """Pick up new and removed checkouts, and forget the ones whose
+        branches have moved."""
+
+        package_map = config.find_packages()
+        if package_map != config.package_map:
+            config.package_map.clear()
+            config.package_map.update(package_map)
+
+        # Broken checkouts are cached as None, and would not be reported
+        # again by compare_against_git(), so they are always reloaded
+        for package, cached in self.checkout_cache.items():
+            if package not in package_map or cached is None:
+                self.drop_checkout(package)
+        for package, path in package_map.iteritems():
+            key = checkout.PackageNameIndex.get_key(path)
+            if self.checkout_keys.get(package) != key:
+                self.drop_checkout(package)
+                self.checkout_keys[package] = key
+
+        # The index itself only recomputes the entries which have changed
+        checkout.package_name_index = None
+
+    def drop_checkout(self, package):
+        cached = self.checkout_cache.pop(package, None)
+        if cached:
+            cached.close_batch()
+
+    def close_batches(self):
+        """Stop the cat-file coprocesses the cached checkouts may have
+        started while answering a query, so that they do not pile up in a
+        long-running daemon."""
+
+        for cached in self.checkout_cache.itervalues():
+            if cached:
+                cached.close_batch()
+
+    def get_out_of_date_binaries(self, distribution, arches):
+        distribution.prefill_control_cache(self.jobs)
+        return distribution.find_out_of_date_binaries(arches)
+
+    def status(self, release, binaries=False):
+        """
+        Compare the development pocket of the release against git.  Returns
+        a dict with:
+        * comparison: (package, git version, APT version, error) tuples
+          for packages which differ, see apt.compare_against_git();
+        * missing: (package, version) tuples for packages not in git;
+        * binaries: (package, version, { arch : (reason, binary) })
+          tuples for packages with out-of-date binaries, if requested;
+        * stats: checkout metadata cache hits and misses of this query, in
+          the process which answered it.
+        """
+
+        stats = dict(checkout.metadata_cache_stats)
+        self.refresh_checkouts()
+        _, _, apt_repo = self.get_release(release)
+
+        comparison = []
+        for package, gitver, aptver in apt.compare_against_git(apt_repo,
+                checkout_cache=self.checkout_cache, jobs=self.jobs):
+            if gitver:
+                comparison.append( (package, str(gitver), str(aptver) if aptver else None, None) )
+            else:
+                comparison.append( (package, None, None, str(aptver)) )
+
+        index = checkout.get_package_name_index(self.jobs)
+        missing = [(package, str(pkginfo.version)) for package, pkginfo in apt_repo.sources.iteritems()
+                   if not index.get_dirname(package) and not package.startswith('debathena-manual-')]
+
+        stats = { key : checkout.metadata_cache_stats[key] - value for key, value in stats.iteritems() }
+        result = { 'comparison' : comparison, 'missing' : missing, 'binaries' : None, 'stats' : stats }
+        if binaries:
+            arches = ['all'] + config.release_arches[apt_repo.release]
+            _, reasons = self.get_out_of_date_binaries(apt_repo, arches)
+            packages = sorted(set().union(*reasons.values()))
+            result['binaries'] = [(package, str(apt_repo.sources[package].version),
+                                   { arch : reasons[arch][package] for arch in arches if package in reasons[arch] })
+                                  for package in packages]
+
+        return result
+
+    def out_of_date(self, distribution, arches):
+        """Returns find_out_of_date_binaries() of the named distribution."""
+
+        return self.get_out_of_date_binaries(self.get_distribution(distribution), arches)
+
+    def build_order(self, repos, arches, bindep_base=None):
+        """
+        Find the out-of-date packages in every repository and resolve the
+        order in which they are built.  Returns the list of (repo, release,
+        package, dependencies, arches) tuples, as dabuild schedules them.
+        If arches is empty, all architectures of the release are built.
+        """
+
+        bindep_distro = self.get_distribution(bindep_base) if bindep_base else None
+        build_list = []
+        for repo in repos:
+            distro = self.get_distribution(repo)
+            distro_arches = arches or (['all'] + config.release_arches[distro.release])
+            build_targets, _ = self.get_out_of_date_binaries(distro, distro_arches)
+
+            repo_bindep_distro = bindep_distro
+            if not repo_bindep_distro and distro.pocket == 'development':
+                _, repo_bindep_distro, _ = self.get_release(distro.release)
+            build_list += buildorder.create_build_schedule(distro, build_targets, distro_arches, repo_bindep_distro)
+
+        return build_list
+
+queries = {
+    'status'      : PlannerState.status,
+    'out-of-date' : PlannerState.out_of_date,
+    'build-order' : PlannerState.build_order,
+}
+
+def encode(value):
+    """Convert the result into JSON-compatible form; sets become sorted
+    lists, tuples lists."""
+
+    if isinstance(value, (set, frozenset)):
+        return sorted(encode(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return { key : encode(item) for key, item in value.iteritems() }
+    return value
+
+def answer(state, query, args):
+    """Run the query against the state, holding the APT repository lock
+    shared so that nothing is written into it meanwhile."""
+
+    if query not in queries:
+        raise BuildError("Unknown planner query %s" % query)
+
+    with locked('apt', exclusive=False):
+        try:
+            return queries[query](state, **args)
+        finally:
+            state.close_batches()
+
+def ask_daemon(query, args):
+    """Send the query to the daemon.  Returns (True, result), or (False,
+    None) if no daemon is running."""
+
+    path = config.planner_socket_path
+    if not path or not os.path.exists(path):
+        return False, None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error as err:
+            if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return False, None
+            raise
+
+        sock.sendall(json.dumps({ 'query' : query, 'args' : args }) + "\n")
+        sock.shutdown(socket.SHUT_WR)
+        response = json.loads(sock.makefile('r').read())
+    finally:
+        sock.close()
+
+    if 'error' in response:
+        raise BuildError("Planner daemon failed: %s" % response['error'])
+    return True, response['result']
+
+def ask(query, jobs=1, **args):
+    """Answer the query, using the daemon if it is running and computing it
+    in-process with up to jobs threads otherwise.  Results from the daemon
+    come through JSON, so tuples and sets are returned as lists."""
+
+    answered, result = ask_daemon(query, args)
+    if answered:
+        return result
+
+    return answer(PlannerState(jobs), query, args)
+
+def get_status(release, binaries=False, jobs=1):
+    return ask('status', jobs, release=release, binaries=binaries)
+
+def get_out_of_date_binaries(distribution, arches, jobs=1):
+    return ask('out-of-date', jobs, distribution=distribution, arches=arches)
+
+def get_build_order(repos, arches, bindep_base=None, jobs=1):
+    """Returns PlannerState.build_order(); the dependencies are always
+    returned as frozensets."""
+
+    build_list = ask('build-order', jobs, repos=repos, arches=arches, bindep_base=bindep_base)
+    return [(repo, release, package, frozenset(deps), list(arches))
+            for repo, release, package, deps, arches in build_list]
+
+def is_daemon_running(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+class PlannerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read())
+            args = { str(key) : value for key, value in request.get('args', {}).iteritems() }
+            response = { 'result' : encode(answer(self.server.state, request['query'], args)) }
+        except Exception as err:
+            response = { 'error' : "%s: %s" % (type(err).__name__, err) }
+            print >>sys.stderr, "Query failed: %s" % response['error']
+
+        self.wfile.write(json.dumps(response))
+
+class PlannerServer(SocketServer.UnixStreamServer):
+    """Answers the queries one at a time over the Unix socket."""
+
+    def __init__(self, path, state):
+        self.state = state
+        SocketServer.UnixStreamServer.__init__(self, path, PlannerHandler)
+
+def serve(state, path=None):
+    """Run the daemon until interrupted.  A socket left behind by a daemon
+    which is no longer running is replaced."""
+
+    path = path or config.planner_socket_path
+    if not path:
+        raise BuildError("No planner socket path configured")
+    if os.path.exists(path):
+        if is_daemon_running(path):
+            raise BuildError("A planner daemon is already listening on %s" % path)
+        os.unlink(path)
+
+    server = PlannerServer(path, state)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
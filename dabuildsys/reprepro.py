@@ -4,11 +4,13 @@
 Abstraction layer around reprepro.
 """
 
+import apt
 import config
+import tracing
 from common import BuildError
+from versions import get_version
 
-from debian.debian_support import Version
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import operator
 import os
 import re
@@ -17,30 +19,69 @@ import subprocess
 def call(*args, **kwargs):
     """Invoke a shell command in the specified repository."""
 
+    global package_versions
+
     cmd = ['reprepro', '-V', '-b', config.apt_root_dir, '--ignore=wrongdistribution'] + list(args)
-    return subprocess.check_output(cmd, stderr = subprocess.STDOUT, **kwargs).strip()
+    try:
+        return tracing.check_output(cmd, 'reprepro ' + args[0], stderr = subprocess.STDOUT, **kwargs).strip()
+    finally:
+        # The command may have changed the repository
+        package_versions = None
 
-# FIXME: this thing is screenscrapping, and regex is awful
-def list_package_versions(package):
-    output = call('ls', package)
-    regex = r"^%s\s+\|\s+(\S+)\s+\|\s+(\S+)\s+\|\s+([a-z0-9, ]+)$" % re.escape(package)
-    matches = re.findall(regex, output, re.MULTILINE)
-    if not matches and len(output) > 0:
-        raise BuildError("Failed to parse `reprepro ls` output")
-    versions = defaultdict(dict)
-    for version, distribution, arches in matches:
-        if 'bleeding' in distribution:
+# { package : { distribution : { architecture : version } } } map of
+# everything in the repository, loaded on first use
+package_versions = None
+
+# Distributions changed with --export=never and not exported since; their
+# exported indexes, which package_versions is read from, are stale
+unexported = set()
+
+@tracing.traced("load package versions")
+def load_package_versions():
+    """Build the map of versions of all source and binary packages in all
+    distributions from the exported indexes, the same way `reprepro ls`
+    would show them for every package."""
+
+    versions = defaultdict(lambda: defaultdict(dict))
+    dists_dir = os.path.join(config.apt_root_dir, 'dists')
+    for distribution in sorted(os.listdir(dists_dir)):
+        path = os.path.join(dists_dir, distribution)
+        # Symlinks are suite names, which `reprepro ls` does not show
+        if 'bleeding' in distribution or os.path.islink(path) or not os.path.isdir(path):
             continue
-        arches = arches.split(', ')
-        for arch in arches:
-            versions[distribution][arch] = Version(version)
+
+        for index_path in apt.find_index_files(os.path.join(path, '*', 'source', 'Sources')):
+            for record in apt.read_sources_file(index_path):
+                versions[record[0]][distribution]['source'] = get_version(record[1])
+
+        # Architecture-independent packages are listed under every architecture
+        for index_path in apt.find_index_files(os.path.join(path, '*', 'binary-*', 'Packages')):
+            arch = os.path.basename(os.path.dirname(index_path))[len('binary-'):]
+            for record in apt.read_packages_file(index_path):
+                versions[record[0]][distribution][arch] = get_version(record[1])
 
     return versions
 
-def find_source_version(package, version):
-    if not isinstance(version, Version):
-        version = Version(version)
+def list_package_versions(package):
+    """Returns { distribution : { architecture : version } } map for the
+    package, excluding bleeding distributions."""
 
+    global package_versions
+
+    if unexported:
+        raise BuildError("The indexes of %s have not been exported since they were changed"
+                % ', '.join(sorted(unexported)))
+    if package_versions is None:
+        package_versions = load_package_versions()
+
+    versions = defaultdict(dict)
+    if package in package_versions:
+        for distribution, arches in package_versions[package].iteritems():
+            versions[distribution].update(arches)
+    return versions
+
+def find_source_version(package, version):
+    version = get_version(version)
     versions = list_package_versions(package)
     # Do not just copy packages from random files, use some well-defined order
     order = versions.keys()
@@ -68,5 +109,154 @@ def copy_package(pkg, from_dist, to_dist, export=True):
     """Copy a specific version of package (APTSourcePackage) from
     one distribution to another."""
 
+    if not export:
+        unexported.add(to_dist)
     print call(*([] if export else ['--export=never']) +
                ['-A', 'source', 'copysrc', to_dist, from_dist, pkg.name, str(pkg.version)])
+
+def source_formula(packages):
+    """Returns the reprepro formula matching the given (name, version) source
+    packages and the binaries built from them.  None as version matches any
+    version.  Only a formula for several packages needs grouping with
+    parentheses, which older reprepro versions do not understand; the
+    callers fall back to running one package at a time if it is rejected."""
+
+    terms = []
+    for name, version in packages:
+        term = "$Source (== %s)" % name
+        if version is not None:
+            term += ", $SourceVersion (== %s)" % version
+            if len(packages) > 1:
+                term = "(%s)" % term
+        terms.append(term)
+    return ' | '.join(terms)
+
+list_regex = re.compile(r"^[^|\s]+\|[^|\s]+\|source: (\S+) (\S+)$", re.MULTILINE)
+
+def list_sources(distribution, packages):
+    """Returns { name : version } map of the given (name, version) source
+    packages present in the distribution, without relying on the exports."""
+
+    output = call('-A', 'source', 'listfilter', distribution, source_formula(packages))
+    return dict(list_regex.findall(output))
+
+class Batch(object):
+    """
+    Collects copies and removals of source packages, and performs them with
+    one reprepro run per (from, to) distribution pair for copies, and per
+    distribution for removals.  Nothing is exported until export() is
+    called, which exports every touched distribution exactly once; until
+    then, list_package_versions() and find_source_version() refuse to
+    answer from the stale exported indexes.
+    """
+
+    def __init__(self, source_only=False):
+        self.source_only = source_only
+        self.copies = OrderedDict()
+        self.removals = OrderedDict()
+        self.touched = []
+
+    def copy(self, name, from_dist, to_dist, version=None):
+        """Queue copying the source package, and unless source_only is set,
+        its binaries; any version present in from_dist if none is given."""
+
+        self.copies.setdefault((from_dist, to_dist), []).append(
+                (name, str(version) if version is not None else None))
+
+    def remove(self, name, dist, version=None):
+        """Queue removing the source package and its binaries."""
+
+        self.removals.setdefault(dist, []).append(
+                (name, str(version) if version is not None else None))
+
+    def touch(self, dist):
+        """Mark the distribution as changed; until it is exported, the
+        versions of packages cannot be looked up."""
+
+        unexported.add(dist)
+        if dist not in self.touched:
+            self.touched.append(dist)
+
+    def run_group(self, keys, packages, source_dist, target_dist, command, expect_present):
+        """Run the reprepro command followed by the formula matching those of
+        the packages which are present in source_dist, and check the outcome
+        in target_dist.  If the command fails for several packages at once,
+        it is retried for them one by one to find out which ones fail."""
+
+        results = {}
+        try:
+            available = list_sources(source_dist, packages)
+        except subprocess.CalledProcessError as err:
+            # Same as below, find out which of the packages fail
+            available = {}
+            for key, package in zip(keys, packages):
+                try:
+                    available.update(list_sources(source_dist, [package]))
+                except subprocess.CalledProcessError as err:
+                    results[key] = 'failed', err.output
+
+        wanted = []
+        for key, (name, version) in zip(keys, packages):
+            if key in results:
+                continue
+            if name in available and version in (None, available[name]):
+                wanted.append( (key, name, available[name]) )
+            else:
+                results[key] = 'missing', ''
+
+        if wanted:
+            self.touch(target_dist)
+        chunks = [wanted] if wanted else []
+        while chunks:
+            chunk = chunks.pop(0)
+            chunk_packages = [(name, version) for _, name, version in chunk]
+            try:
+                output = call(*command + [source_formula(chunk_packages)])
+                present = list_sources(target_dist, chunk_packages)
+            except subprocess.CalledProcessError as err:
+                if len(chunk) > 1:
+                    chunks += [[item] for item in chunk]
+                else:
+                    results[chunk[0][0]] = 'failed', err.output
+                continue
+
+            for key, name, version in chunk:
+                if (present.get(name) == version) == expect_present:
+                    results[key] = 'done', output
+                else:
+                    results[key] = 'failed', output
+
+        return results
+
+    def run(self):
+        """Perform all queued operations.  Returns an ordered map of
+        ('copy', name, from, to) and ('remove', name, dist) requests to
+        (status, output) tuples, where status is 'done', 'missing' if the
+        package was not there to begin with, or 'failed'."""
+
+        results = OrderedDict()
+        copy_options = ['--export=never'] + (['-A', 'source'] if self.source_only else [])
+        copies, self.copies = self.copies, OrderedDict()
+        removals, self.removals = self.removals, OrderedDict()
+
+        for (from_dist, to_dist), packages in copies.iteritems():
+            keys = [('copy', name, from_dist, to_dist) for name, _ in packages]
+            group = self.run_group(keys, packages, from_dist, to_dist,
+                    copy_options + ['copyfilter', to_dist, from_dist], True)
+            results.update((key, group[key]) for key in keys)
+
+        for dist, packages in removals.iteritems():
+            keys = [('remove', name, dist) for name, _ in packages]
+            group = self.run_group(keys, packages, dist, dist,
+                    ['--export=never', 'removefilter', dist], False)
+            results.update((key, group[key]) for key in keys)
+
+        return results
+
+    def export(self):
+        """Export all distributions touched so far."""
+
+        if self.touched:
+            print call('export', *self.touched)
+            unexported.difference_update(self.touched)
+            self.touched = []
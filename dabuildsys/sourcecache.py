@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+"""
+Cache of built source packages, which allows reusing the result of an
+earlier build of exactly the same Debian commit and upstream tree instead
+of running debuild again.
+"""
+
+import config
+import tracing
+
+import hashlib
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Environment variables which may affect the output of `debuild -S`
+environment_variables = ['DEB_BUILD_OPTIONS', 'DEB_VENDOR', 'DEBEMAIL', 'DEBFULLNAME',
+        'EMAIL', 'NAME', 'SOURCE_DATE_EPOCH', 'TZ', 'LANG', 'LC_ALL']
+
+# Files which are never modified after the build are hardlinked out of the
+# cache; others, such as .changes files which get signed, are copied
+hardlink_suffixes = ('.tar.gz', '.tar.bz2', '.tar.xz')
+
+checksums_name = 'SHA256SUMS'
+
+def get_cache_dir():
+    return os.path.join(config.cache_dir, 'source-packages') if config.cache_dir else None
+
+def get_tool_versions():
+    """Returns the versions of the packaging tools used to build source
+    packages."""
+
+    try:
+        return get_tool_versions.result
+    except AttributeError:
+        pass
+
+    try:
+        get_tool_versions.result = tracing.check_output(
+                ['dpkg-query', '-W', '-f', '${Package} ${Version}\n', 'dpkg-dev', 'devscripts'],
+                stderr = subprocess.STDOUT).strip()
+    except (subprocess.CalledProcessError, OSError):
+        get_tool_versions.result = 'unknown'
+    return get_tool_versions.result
+
+def get_build_key(debian_commit, upstream_tree, version):
+    """Returns the key identifying the output of building the source package
+    of the specified version from the Debian commit hash and the upstream
+    tree id in the current environment."""
+
+    environment = [(name, os.environ.get(name)) for name in environment_variables]
+    key = repr((1, debian_commit, upstream_tree, str(version), environment, get_tool_versions()))
+    return hashlib.sha256(key).hexdigest()
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_checksums(entry):
+    checksums = {}
+    with open(os.path.join(entry, checksums_name)) as f:
+        for line in f:
+            checksum, name = line.split()
+            checksums[name] = checksum
+    return checksums
+
+def restore(key, files, destination):
+    """If the cache has the files built for the key, and all of them are
+    intact, put them into the destination directory, replacing any existing
+    files, and return True.  Otherwise return False."""
+
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return False
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        checksums = read_checksums(entry)
+        if set(checksums) != set(files) or \
+           any(file_checksum(os.path.join(entry, name)) != checksums[name] for name in files):
+            raise ValueError("Cache entry %s is damaged" % key)
+    except (IOError, OSError, ValueError):
+        shutil.rmtree(entry, ignore_errors=True)
+        return False
+
+    try:
+        # Entries are evicted in order of last use
+        os.utime(os.path.join(entry, checksums_name), None)
+
+        for name in files:
+            src = os.path.join(entry, name)
+            dst = os.path.join(destination, name)
+            tmp = dst + '.dabuildsys-tmp'
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            try:
+                if not name.endswith(hardlink_suffixes):
+                    raise OSError("Not hardlinking %s" % name)
+                os.link(src, tmp)
+            except OSError:
+                shutil.copy2(src, tmp)
+            os.rename(tmp, dst)
+    except (IOError, OSError):
+        # The entry was evicted in the meantime
+        return False
+
+    return True
+
+def store(key, files, source):
+    """Put a copy of the named files from the source directory into the
+    cache under the key, then evict old entries if the cache is too big.
+    Failure to write the cache is ignored."""
+
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        staging = tempfile.mkdtemp(dir=cache_dir, prefix='.staging-')
+        try:
+            with open(os.path.join(staging, checksums_name), 'w') as f:
+                for name in files:
+                    shutil.copy2(os.path.join(source, name), os.path.join(staging, name))
+                    f.write("%s %s\n" % (file_checksum(os.path.join(staging, name)), name))
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+        except:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+    except (IOError, OSError):
+        return
+
+    prune(config.source_cache_size)
+
+def get_entries():
+    """Returns the list of (last use time, size, path) of all cache entries."""
+
+    cache_dir = get_cache_dir()
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        try:
+            if name.startswith('.staging-'):
+                # Leave alone the entries being stored right now, but not
+                # the ones left behind by killed builds
+                if os.stat(entry).st_mtime > time.time() - 24 * 3600:
+                    continue
+                raise OSError("Stale staging directory %s" % name)
+            last_used = os.stat(os.path.join(entry, checksums_name)).st_mtime
+            size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+        except OSError:
+            last_used, size = 0, 0
+        entries.append( (last_used, size, entry) )
+    return entries
+
+def prune(max_size):
+    """Remove the least recently used entries until the total size of the
+    cache is at most max_size bytes.  Returns (entries removed, bytes
+    freed)."""
+
+    entries = sorted(get_entries())
+    total = sum(size for _, size, _ in entries)
+    removed, freed = 0, 0
+    for last_used, size, entry in entries:
+        if total <= max_size and last_used:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
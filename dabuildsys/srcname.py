@@ -10,22 +10,36 @@ import apt
 import config
 import checkout
 
-def expand_srcname_spec(spec, full_clean=False):
+def is_explicit_spec(spec):
+    """Checks whether the spec lists the packages by name, as opposed to '*'
+    or some variant of 'all'."""
+
+    return len(spec) > 1 or not (spec[0] == '*' or spec[0].startswith('all'))
+
+def expand_srcname_spec(spec, full_clean=False, jobs=1, update_timeout=None):
     """Parse a list of source packages on which the operation is to be performed.
     If some variant of 'all' is specified, comparison against packages currently
     APT repository is made and packages which have older version in APT than in Git
-    are returned."""
+    are returned.  Up to jobs checkouts are loaded in parallel.  If full_clean is
+    set, all the relevant repositories are updated from remote first; if any
+    of the explicitly specified packages fails to update, BuildError is raised,
+    while for 'all' and '*' such packages are left out of the result."""
+
+    explicit = is_explicit_spec(spec)
+    failed = set()
+    if full_clean:
+        results = checkout.update_checkouts(spec if explicit else sorted(config.package_map),
+                jobs=jobs, timeout=update_timeout)
+        checkout.print_update_summary(results)
+        failed = set(package for package, elapsed, error in results if error)
+        if explicit and failed:
+            raise BuildError("Failed to update %s" % ', '.join(sorted(failed)))
 
     if len(spec) == 1 and spec[0] == '*':
-        checkouts = []
-        for pkg in config.package_map:
-            try:
-                checkouts.append(checkout.PackageCheckout(pkg, full_clean=full_clean))
-            except Exception as e:
-                pass
-        return checkouts, {}
-    elif len(spec) > 1 or not spec[0].startswith('all'):
-        return [checkout.PackageCheckout(pkg, full_clean=full_clean) for pkg in spec], {}
+        checkouts = checkout.load_checkouts(sorted(config.package_map), jobs=jobs, catch=Exception)
+        return [c for c in checkouts if not isinstance(c, Exception) and c.dirname not in failed], {}
+    elif explicit:
+        return checkout.load_checkouts(spec, jobs=jobs, catch=()), {}
     else:
         if spec[0] == 'all':
             releases = config.releases
@@ -37,10 +51,11 @@ def expand_srcname_spec(spec, full_clean=False):
         cache = {}
         packages = set()
         repos = {}
+        index = checkout.get_package_name_index(jobs)
         for release in releases:
             _, _, apt_repo = apt.get_release(release)
             repos[release] = apt_repo
-            comparison = apt.compare_against_git(apt_repo, update_all=full_clean, checkout_cache=cache)
-            packages |= set(checkout.lookup_by_package_name(pkg) for pkg, gitver, aptver in comparison if gitver)
+            comparison = apt.compare_against_git(apt_repo, checkout_cache=cache, jobs=jobs)
+            packages |= set(index.get_dirname(pkg) for pkg, gitver, aptver in comparison if gitver)
 
-        return [cache[pkg] for pkg in packages], repos
+        return [cache[pkg] for pkg in packages if pkg not in failed], repos
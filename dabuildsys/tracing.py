@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+"""
+Opt-in instrumentation of the child processes and the phases of a run.  It
+is enabled by setting DEBATHENA_TRACE to a file name, or by the --trace
+option of the tools.  Every subprocess started through check_output() and
+every span is recorded, and at exit the events are written into the file in
+the Chrome trace event format (load it in chrome://tracing or Perfetto) and
+a per-command summary is printed to stderr.
+"""
+
+import config
+
+from collections import defaultdict
+from functools import wraps
+import atexit
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+trace_path = None
+events = []
+events_lock = threading.Lock()
+start_time = time.time()
+
+def enable(path):
+    """Start recording events, to be written into path at exit."""
+
+    global trace_path
+    if trace_path is None:
+        atexit.register(finish)
+    trace_path = path
+
+def is_enabled():
+    return trace_path is not None
+
+def record(category, name, start, end, args):
+    event = {
+        'name' : name,
+        'cat'  : category,
+        'ph'   : 'X',
+        'ts'   : int((start - start_time) * 1e6),
+        'dur'  : int((end - start) * 1e6),
+        'pid'  : os.getpid(),
+        'tid'  : threading.current_thread().ident,
+        'args' : args,
+    }
+    with events_lock:
+        events.append(event)
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Record the with block as a phase of the run."""
+
+    if not is_enabled():
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        record('phase', name, start, time.time(), args)
+
+def traced(name):
+    """Decorator recording every call of the function as a phase."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run(func, cmd, label, kwargs):
+    if not is_enabled():
+        return func(cmd, **kwargs)
+
+    start = time.time()
+    status, output = 0, None
+    try:
+        output = func(cmd, **kwargs)
+        return output
+    except subprocess.CalledProcessError as err:
+        status, output = err.returncode, err.output
+        raise
+    except OSError as err:
+        status = -err.errno
+        raise
+    finally:
+        record('subprocess', label or os.path.basename(cmd[0]), start, time.time(), {
+            'argv'   : list(cmd),
+            'cwd'    : kwargs.get('cwd') or os.getcwd(),
+            'status' : status,
+            'output' : len(output) if isinstance(output, str) else 0,
+        })
+
+def check_output(cmd, label=None, **kwargs):
+    """subprocess.check_output() which records the command when tracing is
+    enabled.  The label groups commands in the summary and defaults to the
+    name of the program."""
+
+    return run(subprocess.check_output, cmd, label, kwargs)
+
+def check_call(cmd, label=None, **kwargs):
+    return run(subprocess.check_call, cmd, label, kwargs)
+
+def summarize(category='subprocess'):
+    """Returns (name, count, failures, total seconds, longest seconds,
+    output bytes) tuples for every kind of event in the category, most
+    expensive first."""
+
+    totals = defaultdict(lambda: [0, 0, 0, 0, 0])
+    with events_lock:
+        for event in events:
+            if event['cat'] != category:
+                continue
+            total = totals[event['name']]
+            total[0] += 1
+            total[1] += event['args'].get('status', 0) != 0
+            total[2] += event['dur']
+            total[3] = max(total[3], event['dur'])
+            total[4] += event['args'].get('output', 0)
+
+    summary = [(name, count, failures, total / 1e6, longest / 1e6, output)
+               for name, (count, failures, total, longest, output) in totals.iteritems()]
+    summary.sort(key=lambda entry: (-entry[3], entry[0]))
+    return summary
+
+def print_summary(out=sys.stderr):
+    print >>out, "%-28s %6s %6s %10s %9s %10s" % ("Command", "Runs", "Failed", "Total", "Longest", "Output")
+    for name, count, failures, total, longest, output in summarize():
+        print >>out, "%-28s %6i %6i %9.2fs %8.2fs %9.1fk" % (name, count, failures, total, longest, output / 1024.0)
+
+    print >>out
+    print >>out, "%-28s %6s %6s %10s %9s" % ("Phase", "Runs", "", "Total", "Longest")
+    for name, count, _, total, longest, _ in summarize('phase'):
+        print >>out, "%-28s %6i %6s %9.2fs %8.2fs" % (name, count, "", total, longest)
+
+def finish():
+    """Write the trace file and print the summary."""
+
+    with events_lock:
+        trace = { 'traceEvents' : list(events), 'displayTimeUnit' : 'ms' }
+    with open(trace_path, 'w') as f:
+        json.dump(trace, f)
+    print_summary()
+    print >>sys.stderr, "Trace written into %s" % trace_path
+
+if config.trace_path:
+    enable(config.trace_path)
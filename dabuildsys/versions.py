@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+"""
+Interned Debian versions.  Version from python-debian re-runs the Debian
+comparison algorithm in pure Python on every comparison, which adds up in
+the loops over all packages of a release.  Here every distinct version
+string is parsed once into a tuple which compares the same way, and the
+same object is returned for it afterwards.
+"""
+
+from debian.debian_support import Version
+
+import re
+
+# Splits a part into (non-digits, digits) pairs
+pair_pattern = re.compile(r'(\D*)(\d*)')
+
+# Sort key of an empty part, which is what Debian pads shorter versions with
+empty_pair = ((0,), 0)
+
+def get_char_order(char):
+    """Order of a non-digit character in Debian version comparison."""
+
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def get_part_key(part):
+    """
+    Sort key of the upstream version or the Debian revision.  The part is
+    split into (non-digits, digits) pairs, with the non-digits turned into
+    a tuple of character orders ending with 0, which is what a missing
+    character compares as.  Trailing empty pairs are dropped and two are
+    appended instead, so that a shorter part compares against the rest of
+    a longer one the way padding with empty pairs would; only the first
+    pair may be empty otherwise.
+    """
+
+    pairs = [(tuple(get_char_order(char) for char in letters) + (0,), int(digits or '0'))
+             for letters, digits in pair_pattern.findall(part) if letters or digits]
+    while pairs and pairs[-1] == empty_pair:
+        pairs.pop()
+    return tuple(pairs) + (empty_pair, empty_pair)
+
+def get_sort_key(version):
+    """Returns the tuple which orders the same way as the version."""
+
+    return (int(version.epoch or '0'),
+            get_part_key(version.upstream_version or '0'),
+            get_part_key(version.debian_revision or '0'))
+
+class InternedVersion(Version):
+    """Version which compares by its precomputed sort key against other
+    interned versions, and the usual way against anything else.  The
+    objects are shared, so they must not be modified."""
+
+    def __init__(self, version):
+        Version.__init__(self, version)
+        self.sort_key = get_sort_key(self)
+
+    def _compare(self, other):
+        if isinstance(other, InternedVersion):
+            return cmp(self.sort_key, other.sort_key)
+        return Version._compare(self, other)
+
+    def __lt__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key < other.sort_key
+        return Version.__lt__(self, other)
+
+    def __le__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key <= other.sort_key
+        return Version.__le__(self, other)
+
+    def __eq__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key == other.sort_key
+        return Version.__eq__(self, other)
+
+    def __ne__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key != other.sort_key
+        return Version.__ne__(self, other)
+
+    def __ge__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key >= other.sort_key
+        return Version.__ge__(self, other)
+
+    def __gt__(self, other):
+        if isinstance(other, InternedVersion):
+            return self.sort_key > other.sort_key
+        return Version.__gt__(self, other)
+
+    def __setattr__(self, attr, value):
+        if hasattr(self, 'sort_key'):
+            raise AttributeError("Interned versions cannot be modified")
+        Version.__setattr__(self, attr, value)
+
+    def __reduce__(self):
+        return get_version, (self.full_version,)
+
+# { version string : InternedVersion }
+interned_versions = {}
+
+def get_version(version):
+    """Returns the interned version for the version string or Version
+    object, parsing it on first use."""
+
+    version = str(version)
+    try:
+        return interned_versions[version]
+    except KeyError:
+        return interned_versions.setdefault(version, InternedVersion(version))